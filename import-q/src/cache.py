@@ -6,3 +6,12 @@ CACHE = diskcache.Cache(SCRIPT_DIR.parent / "cache")
 
 # dedicated cache for interactive review decisions, so we can iterate it safely
 DECISIONS = diskcache.Cache(SCRIPT_DIR.parent / "cache-decisions")
+
+# perceptual hashes and thumbnails of the images, see check_imgs.load_features
+IMAGE_INDEX = diskcache.Cache(SCRIPT_DIR.parent / "cache-imgindex")
+
+# image dedup decisions only, so that loading them all is a single pass
+DEDUP_DECISIONS = diskcache.Cache(SCRIPT_DIR.parent / "cache-dedup-decisions")
+
+# thumbnails and dimensions of the images shown in the dedup review page
+THUMBNAILS = diskcache.Cache(SCRIPT_DIR.parent / "cache-thumbnails")
@@ -0,0 +1,851 @@
+#!/usr/bin/env -S uv run --script
+# coding: utf-8
+# Licence: GNU AGPLv3
+
+"""Duplicate image detection for the BIA annales.
+
+Two images are reported as duplicates when:
+- their bytes are identical (exact duplicates: same size, then same digest of
+  the first EXACT_BLOCK bytes, then same full digest), or
+- the Hamming distance between their perceptual hashes is <= threshold and
+  the SSIM of their grayscale thumbnails is >= ssim_threshold.
+
+Candidate pairs are found with a multi-index over the hashes (HashIndex)
+rather than by comparing all pairs; ImageIndex.query answers "does this image already
+exist?" for a single new image (see also `check_imgs.py query <image>...`).
+
+Per-image features are kept in a persistent index (see IMAGE_INDEX), keyed by
+path and validated with size/mtime and the content digest, so a rescan only
+decodes new or modified images, at a reduced scale (JPEG draft mode). The SSIM
+thumbnails live in a memory-mapped file next to it (ThumbStore), and SSIM is
+computed one image against a batch of candidates (ssim_batch).
+"""
+
+from __future__ import annotations
+
+import argparse
+import fcntl
+import hashlib
+import io
+import multiprocessing
+import os
+import resource
+import secrets
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from functools import cache
+from itertools import combinations, groupby
+from pathlib import Path
+from typing import Callable, Iterator, Sequence
+
+from PIL import Image, ImageOps
+
+from cache import IMAGE_INDEX
+from utils import add_jobs_argument
+
+# bump when the features below change, to invalidate the persistent index
+FEATURES_VERSION = 5
+PHASH_SIZE = 8  # 64-bit hash
+PHASH_HIGHFREQ = 4  # the DCT is computed on a (8*4)x(8*4) image
+SSIM_SIZE = 64
+SSIM_WIN = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+# max difference between ssim_batch and ssim: the window sums are exact
+# integers in the former, float sums in the latter
+SSIM_TOLERANCE = 1e-9
+THUMBS_KEY = f"thumbs-file-v{FEATURES_VERSION}"
+THUMB_BYTES = SSIM_SIZE * SSIM_SIZE
+EXACT_BLOCK = 16 * 1024
+
+# progress(phase, done, total), called as a scan advances
+Progress = Callable[[str, int, int], None]
+
+
+@dataclass
+class SimilarPair:
+    a: Path
+    b: Path
+    hamming: int
+    ssim: float
+
+
+@dataclass
+class ImageFeatures:
+    size: int
+    mtime_ns: int
+    head_sha256: str  # digest of the first EXACT_BLOCK bytes
+    sha256: str | None  # full digest, only computed when needed
+    phash: int
+    thumbs: str  # ThumbStore file holding the SSIM thumbnail
+    thumb_row: int
+
+
+class ThumbStore:
+    """Append-only file of SSIM_SIZE x SSIM_SIZE grayscale thumbnails (uint8).
+
+    Rows are read through a memory map. The file name is recorded in
+    IMAGE_INDEX and in every entry pointing to one of its rows: if the file
+    goes missing, a new one is started and the old rows are no longer valid.
+    Several processes may append at once (the review app and an import
+    script): appends hold an exclusive lock, and the row of a thumbnail is
+    where its write landed in the file.
+    """
+
+    def __init__(self) -> None:
+        directory = Path(IMAGE_INDEX.directory)
+        name = IMAGE_INDEX.get(THUMBS_KEY)
+        if not isinstance(name, str) or not (directory / name).is_file():
+            name = f"thumbs-{secrets.token_hex(4)}.u8"
+            (directory / name).touch()
+            IMAGE_INDEX.set(THUMBS_KEY, name)
+        self.name = name
+        self.path = directory / name
+        self.rows = 0
+        self._map: np.ndarray | None = None
+        self._sync()
+
+    def _sync(self) -> None:
+        """Catch up with the rows appended by other processes."""
+        rows = self.path.stat().st_size // THUMB_BYTES
+        if rows != self.rows:
+            self.rows = rows
+            self._map = None
+
+    def __contains__(self, f: ImageFeatures) -> bool:
+        if f.thumbs != self.name:
+            return False
+        if f.thumb_row >= self.rows:
+            self._sync()
+        return 0 <= f.thumb_row < self.rows
+
+    def append(self, thumb: np.ndarray) -> int:
+        data = np.ascontiguousarray(thumb, dtype=np.uint8).tobytes()
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                end = f.seek(0, os.SEEK_END)
+                row = end // THUMB_BYTES
+                # drop a partially written row, left by a crashed writer
+                if end != row * THUMB_BYTES:
+                    f.truncate(row * THUMB_BYTES)
+                f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.rows = row + 1
+        self._map = None
+        return row
+
+    def array(self) -> np.ndarray:
+        if self._map is None:
+            if self.rows == 0:
+                self._map = np.empty((0, SSIM_SIZE, SSIM_SIZE), dtype=np.uint8)
+            else:
+                self._map = np.memmap(
+                    self.path,
+                    dtype=np.uint8,
+                    mode="r",
+                    shape=(self.rows, SSIM_SIZE, SSIM_SIZE),
+                )
+        return self._map
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+
+_DCT = _dct_matrix(PHASH_SIZE * PHASH_HIGHFREQ)
+
+
+def phash(gray: Image.Image) -> int:
+    """64-bit DCT perceptual hash: low frequencies compared to their median."""
+    n = PHASH_SIZE * PHASH_HIGHFREQ
+    pixels = np.asarray(gray.resize((n, n), Image.Resampling.LANCZOS), np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:PHASH_SIZE, :PHASH_SIZE]
+    bits = (low > np.median(low)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def ssim(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean SSIM over SSIM_WIN x SSIM_WIN uniform windows (no padding)."""
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    win = (SSIM_WIN, SSIM_WIN)
+
+    def mean(x: np.ndarray) -> np.ndarray:
+        return np.lib.stride_tricks.sliding_window_view(x, win).mean(axis=(-2, -1))
+
+    mu_a, mu_b = mean(a), mean(b)
+    # unbiased (co)variances, as skimage does by default
+    norm = SSIM_WIN * SSIM_WIN / (SSIM_WIN * SSIM_WIN - 1)
+    var_a = (mean(a * a) - mu_a * mu_a) * norm
+    var_b = (mean(b * b) - mu_b * mu_b) * norm
+    cov = (mean(a * b) - mu_a * mu_b) * norm
+    s = ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)) / (
+        (mu_a * mu_a + mu_b * mu_b + SSIM_C1) * (var_a + var_b + SSIM_C2)
+    )
+    return float(s.mean())
+
+
+def _window_sums(x: np.ndarray) -> np.ndarray:
+    """Sums over the SSIM_WIN x SSIM_WIN windows of the last two axes."""
+    c = np.cumsum(np.cumsum(x, axis=-1), axis=-2)
+    c = np.pad(c, [(0, 0)] * (x.ndim - 2) + [(1, 0), (1, 0)])
+    w = SSIM_WIN
+    return c[..., w:, w:] - c[..., :-w, w:] - c[..., w:, :-w] + c[..., :-w, :-w]
+
+
+def ssim_batch(a: np.ndarray, bs: np.ndarray) -> np.ndarray:
+    """ssim(a, b) for every b of the (k, H, W) array bs, within SSIM_TOLERANCE.
+
+    Window sums come from integral images computed on integers, so the only
+    float work left is the per-window SSIM formula.
+    """
+    a = a.astype(np.int64)
+    bs = bs.astype(np.int64)
+    n = SSIM_WIN * SSIM_WIN
+    sum_a = _window_sums(a)
+    sum_b = _window_sums(bs)
+    mu_a = sum_a / n
+    mu_b = sum_b / n
+    # unbiased (co)variances, as in ssim()
+    var_a = (_window_sums(a * a) - sum_a * mu_a) / (n - 1)
+    var_b = (_window_sums(bs * bs) - sum_b * mu_b) / (n - 1)
+    cov = (_window_sums(bs * a) - sum_b * mu_a) / (n - 1)
+    s = ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)) / (
+        (mu_a * mu_a + mu_b * mu_b + SSIM_C1) * (var_a + var_b + SSIM_C2)
+    )
+    return s.mean(axis=(-2, -1))
+
+
+def compute_features(
+    path: Path, data: bytes, size: int, mtime_ns: int
+) -> tuple[ImageFeatures, np.ndarray]:
+    """Return the features of an image (not stored yet) and its thumbnail."""
+    with Image.open(io.BytesIO(data)) as image:
+        # only thumbnails are needed: let the JPEG decoder downscale (up to 8x)
+        # as long as both sides stay >= SSIM_SIZE, much faster on large scans
+        image.draft("L", (SSIM_SIZE, SSIM_SIZE))
+        gray = ImageOps.exif_transpose(image).convert("L")
+    thumb = gray.resize((SSIM_SIZE, SSIM_SIZE), Image.Resampling.LANCZOS)
+    head = hashlib.sha256(data[:EXACT_BLOCK]).hexdigest()
+    features = ImageFeatures(
+        size=size,
+        mtime_ns=mtime_ns,
+        head_sha256=head,
+        sha256=head if size <= EXACT_BLOCK else None,
+        phash=phash(gray),
+        thumbs="",
+        thumb_row=-1,
+    )
+    return features, np.asarray(thumb, dtype=np.uint8)
+
+
+def peak_rss_mib(children: bool = False) -> float:
+    """Peak resident memory of this process so far, or of its largest
+    finished child (the --jobs workers) with `children`."""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def peak_memory(jobs: int = 1) -> str:
+    res = f"peak memory {peak_rss_mib():.1f} MiB"
+    if jobs > 1:
+        res += f", largest worker {peak_rss_mib(children=True):.1f} MiB"
+    return res
+
+
+def index_key(path: Path) -> str:
+    return f"v{FEATURES_VERSION}:{path.resolve()}"
+
+
+def file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _same_content(path: Path, size: int, features: ImageFeatures) -> bool:
+    """Whether `path` still has the content described by `features`, checked
+    by size, then first block, then full digest (if it was ever computed)."""
+    if size != features.size:
+        return False
+    with open(path, "rb") as f:
+        head = f.read(EXACT_BLOCK)
+        if hashlib.sha256(head).hexdigest() != features.head_sha256:
+            return False
+        if size <= EXACT_BLOCK:
+            return True
+        if features.sha256 is None:
+            return False
+        f.seek(0)
+        return hashlib.file_digest(f, "sha256").hexdigest() == features.sha256
+
+
+def _refresh(
+    path: Path, features: ImageFeatures | None
+) -> tuple[ImageFeatures, np.ndarray | None]:
+    """Re-read an image that is new or whose size or mtime changed.
+
+    Return the entry with the new stat when the content did not change,
+    otherwise new features along with the thumbnail to store.
+    """
+    st = path.stat()
+    if features is not None and _same_content(path, st.st_size, features):
+        features.mtime_ns = st.st_mtime_ns
+        return features, None
+    data = path.read_bytes()
+    return compute_features(path, data, len(data), st.st_mtime_ns)
+
+
+def _refresh_chunk(
+    items: list[tuple[Path, ImageFeatures | None]],
+) -> list[tuple[ImageFeatures, np.ndarray | None]]:
+    return [_refresh(path, features) for path, features in items]
+
+
+def _iter_refresh(
+    items: list[tuple[Path, ImageFeatures | None]], jobs: int
+) -> Iterator[tuple[ImageFeatures, np.ndarray | None]]:
+    if jobs <= 1 or len(items) < 2:
+        for path, features in items:
+            yield _refresh(path, features)
+        return
+    # a few chunks per worker, so that a slow chunk does not stall the pool;
+    # `map` keeps them in order
+    size = max(1, -(-len(items) // (jobs * 4)))
+    chunks = [items[i : i + size] for i in range(0, len(items), size)]
+    # not forked: scans also run from a thread of the review app's server,
+    # and a forked child could inherit locks held by the other threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        for chunk in pool.map(_refresh_chunk, chunks):
+            yield from chunk
+
+
+def load_features(
+    paths: Sequence[Path],
+    thumbs: ThumbStore,
+    verbose: bool = False,
+    jobs: int = 1,
+    progress: Progress | None = None,
+) -> list[ImageFeatures]:
+    """Return the features of every path, computing only the missing ones.
+
+    An entry is reused as is when size and mtime match; otherwise the file is
+    read and the entry is reused if its content digest did not change. With
+    jobs > 1 the files are read and decoded in worker processes; thumbnails are
+    still stored in the order of `paths`, whatever the number of workers.
+    """
+    res: list[ImageFeatures | None] = []
+    stale: list[tuple[Path, ImageFeatures | None]] = []
+    stale_pos: list[int] = []
+    for path in paths:
+        st = path.stat()
+        # stored as plain dicts, so that entries do not depend on this module
+        # being imported or run as __main__
+        value = IMAGE_INDEX.get(index_key(path))
+        features = ImageFeatures(**value) if isinstance(value, dict) else None
+        if features is not None and features not in thumbs:
+            features = None
+        if features is not None and (features.size, features.mtime_ns) == (
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            res.append(features)
+            continue
+        stale_pos.append(len(res))
+        stale.append((path, features))
+        res.append(None)
+
+    touched = computed = 0
+    for pos, (features, thumb) in zip(stale_pos, _iter_refresh(stale, jobs)):
+        if thumb is None:
+            touched += 1
+        else:
+            features.thumbs = thumbs.name
+            features.thumb_row = thumbs.append(thumb)
+            computed += 1
+        IMAGE_INDEX.set(index_key(paths[pos]), asdict(features))
+        res[pos] = features
+        if progress is not None:
+            progress("hashing images", touched + computed, len(stale))
+    if verbose:
+        print(
+            f"Image index: {len(paths) - len(stale)} cached, {touched} unchanged "
+            f"content, {computed} hashed"
+        )
+    return [f for f in res if f is not None]
+
+
+MIH_BLOCKS = 4
+MIH_BLOCK_BITS = 64 // MIH_BLOCKS
+MIH_BLOCK_MASK = (1 << MIH_BLOCK_BITS) - 1
+# looking up a neighbouring block costs about as much as comparing this many
+# hashes in a vectorized scan, which also wins for single queries on small sets
+MIH_SCAN_COST = 160
+MIH_MIN_HASHES = 50_000
+
+
+@cache
+def _block_masks(r: int) -> np.ndarray:
+    """Every MIH_BLOCK_BITS-bit mask with at most r bits set."""
+    return np.array(
+        [
+            sum(1 << bit for bit in bits)
+            for k in range(r + 1)
+            for bits in combinations(range(MIH_BLOCK_BITS), k)
+        ],
+        dtype=np.uint64,
+    )
+
+
+def _gather_ranges(order: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Concatenation of order[lo[k]:hi[k]] for every k."""
+    lengths = hi - lo
+    starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+    return order[starts + np.arange(lengths.sum())]
+
+
+class HashIndex:
+    """Multi-index hashing over 64-bit hashes with the Hamming distance.
+
+    Hashes are split into MIH_BLOCKS blocks, each kept sorted in its own table.
+    Two hashes within distance t have at least one block within t // MIH_BLOCKS
+    (pigeonhole), so only the hashes sharing a neighbouring block value are
+    compared, found by bisection in the tables.
+    """
+
+    def __init__(self) -> None:
+        self.hashes: list[int] = []
+        self._array: np.ndarray | None = None
+        # per block: (sorted block values, items in that order)
+        self._tables: list[tuple[np.ndarray, np.ndarray]] = []
+
+    def add(self, h: int) -> int:
+        self.hashes.append(h)
+        self._array = None
+        return len(self.hashes) - 1
+
+    def _build(self) -> np.ndarray:
+        if self._array is None:
+            self._array = np.array(self.hashes, dtype=np.uint64)
+            self._tables = []
+            for b in range(MIH_BLOCKS):
+                blocks = (self._array >> np.uint64(b * MIH_BLOCK_BITS)) & np.uint64(
+                    MIH_BLOCK_MASK
+                )
+                order = np.argsort(blocks, kind="stable")
+                self._tables.append((blocks[order], order))
+        return self._array
+
+    def _masks(self, t: int) -> np.ndarray | None:
+        """Block masks to look up for threshold t, None if a scan is cheaper."""
+        masks = _block_masks(min(t // MIH_BLOCKS, MIH_BLOCK_BITS))
+        if len(masks) * MIH_BLOCKS * MIH_SCAN_COST >= len(self.hashes):
+            return None
+        return masks
+
+    def within(self, h: int, t: int) -> list[tuple[int, int]]:
+        """Return (distance, item) for every hash at distance <= t of h."""
+        array = self._build()
+        masks = self._masks(t)
+        if masks is None or len(array) < MIH_MIN_HASHES:
+            items = np.arange(len(array))
+        else:
+            found = []
+            for b, (blocks, order) in enumerate(self._tables):
+                block = np.uint64((h >> (b * MIH_BLOCK_BITS)) & MIH_BLOCK_MASK)
+                neighbours = block ^ masks
+                lo = np.searchsorted(blocks, neighbours, side="left")
+                hi = np.searchsorted(blocks, neighbours, side="right")
+                found.append(_gather_ranges(order, lo, hi))
+            items = np.unique(np.concatenate(found))
+        dists = np.bitwise_count(array[items] ^ np.uint64(h))
+        keep = dists <= t
+        return list(zip(dists[keep].tolist(), items[keep].tolist()))
+
+    def pairs_within(self, t: int) -> list[tuple[int, int, int]]:
+        """Return (i, j, distance) for every pair of items i < j within t.
+
+        The pairs are sorted by (i, j).
+        """
+        array = self._build()
+        n = len(array)
+        masks = self._masks(t)
+        if masks is None:
+            res = []
+            for i in range(n - 1):
+                dists = np.bitwise_count(array[i + 1 :] ^ array[i])
+                js = np.flatnonzero(dists <= t)
+                res.extend(
+                    zip([i] * len(js), (js + i + 1).tolist(), dists[js].tolist())
+                )
+            return res
+        # self-join of every table with itself, one neighbouring mask at a time
+        found = []
+        for blocks, order in self._tables:
+            for mask in masks:
+                neighbours = blocks ^ mask
+                lo = np.searchsorted(blocks, neighbours, side="left")
+                hi = np.searchsorted(blocks, neighbours, side="right")
+                src = np.repeat(order, hi - lo)
+                dst = _gather_ranges(order, lo, hi)
+                dists = np.bitwise_count(array[src] ^ array[dst])
+                keep = (src < dst) & (dists <= t)
+                found.append(src[keep] * n + dst[keep])
+        # a pair close in several blocks is found once per block
+        codes = np.unique(np.concatenate(found))
+        i, j = np.divmod(codes, n)
+        dists = np.bitwise_count(array[i] ^ array[j])
+        return list(zip(i.tolist(), j.tolist(), dists.tolist()))
+
+
+class ImageIndex:
+    """Features of a set of images, with a HashIndex over their hashes."""
+
+    def __init__(
+        self,
+        paths: Sequence[Path],
+        verbose: bool = False,
+        jobs: int = 1,
+        progress: Progress | None = None,
+    ) -> None:
+        self.paths = list(paths)
+        self.store = ThumbStore()
+        self.features = load_features(self.paths, self.store, verbose, jobs, progress)
+        self.hashes = HashIndex()
+        for f in self.features:
+            self.hashes.add(f.phash)
+
+    def add(self, path: Path) -> None:
+        self.paths.append(path)
+        self.features.extend(load_features([path], self.store))
+        self.hashes.add(self.features[-1].phash)
+
+    def digest(self, i: int) -> str:
+        """Full digest of an item, computed on first use and persisted."""
+        f = self.features[i]
+        if f.sha256 is None:
+            f.sha256 = file_digest(self.paths[i])
+            IMAGE_INDEX.set(index_key(self.paths[i]), asdict(f))
+        return f.sha256
+
+    def exact_duplicates(self, verbose: bool = False) -> dict[str, list[int]]:
+        """Group the byte-identical items by digest.
+
+        Items are bucketed by size, then by digest of their first block; only
+        the items still colliding get their full digest computed (once, since
+        it is persisted in the index).
+        """
+        by_size: dict[int, list[int]] = {}
+        for i, f in enumerate(self.features):
+            by_size.setdefault(f.size, []).append(i)
+        res: dict[str, list[int]] = {}
+        same_size = same_head = 0
+        for items in by_size.values():
+            if len(items) < 2:
+                continue
+            same_size += len(items)
+            by_head: dict[str, list[int]] = {}
+            for i in items:
+                by_head.setdefault(self.features[i].head_sha256, []).append(i)
+            for candidates in by_head.values():
+                if len(candidates) < 2:
+                    continue
+                same_head += len(candidates)
+                for i in candidates:
+                    res.setdefault(self.digest(i), []).append(i)
+        if verbose:
+            print(
+                f"Exact duplicates: {same_size} files share their size, "
+                f"{same_head} also their first {EXACT_BLOCK // 1024} KiB"
+            )
+        return {digest: items for digest, items in res.items() if len(items) > 1}
+
+    def thumbs(self, items: Sequence[int]) -> np.ndarray:
+        """Thumbnails of the given items, as a (len(items), H, W) array."""
+        rows = [self.features[i].thumb_row for i in items]
+        return self.store.array()[rows]
+
+    def query(
+        self, path: Path, threshold: int, ssim_threshold: float
+    ) -> list[SimilarPair]:
+        """Return the indexed images duplicating `path`, closest first.
+
+        `path` itself does not need to be indexed (nor stored in IMAGE_INDEX);
+        byte-identical images are reported with an SSIM of 1.
+        """
+        data = path.read_bytes()
+        st = path.stat()
+        f, thumb = compute_features(path, data, len(data), st.st_mtime_ns)
+        digest = hashlib.sha256(data).hexdigest()
+        found = self.hashes.within(f.phash, threshold)
+        scores = ssim_batch(thumb, self.thumbs([i for _, i in found]))
+        res = []
+        for (dist, i), score in zip(found, scores.tolist()):
+            other = self.features[i]
+            if (
+                other.size == f.size
+                and other.head_sha256 == f.head_sha256
+                and self.digest(i) == digest
+            ):
+                score = 1.0
+            elif score < ssim_threshold:
+                continue
+            res.append(SimilarPair(path, self.paths[i], dist, score))
+        res.sort(key=lambda p: (p.hamming, -p.ssim, p.b.name))
+        return res
+
+
+@dataclass
+class EdgeList:
+    """Every similar pair up to the loosest thresholds of a scan.
+
+    Pairs are sorted by Hamming distance, so any stricter (threshold,
+    ssim_threshold) is answered by a bisection and a filter, without rescanning.
+    """
+
+    paths: list[Path]
+    exact: dict[str, list[str]]
+    pairs: list[SimilarPair]
+    max_threshold: int
+    min_ssim: float
+    _hammings: list[int] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.pairs.sort(key=lambda p: (p.hamming, -p.ssim, p.a.name, p.b.name))
+        self._hammings = [p.hamming for p in self.pairs]
+
+    def covers(self, threshold: int, ssim_threshold: float) -> bool:
+        return threshold <= self.max_threshold and ssim_threshold >= self.min_ssim
+
+    def select(self, threshold: int, ssim_threshold: float) -> list[SimilarPair]:
+        assert self.covers(threshold, ssim_threshold)
+        end = bisect_right(self._hammings, threshold)
+        return [p for p in self.pairs[:end] if p.ssim >= ssim_threshold]
+
+
+def scan_edges(
+    paths: Sequence[Path],
+    max_threshold: int,
+    min_ssim: float,
+    verbose: bool = False,
+    jobs: int = 1,
+    progress: Progress | None = None,
+) -> EdgeList:
+    index = ImageIndex(paths, verbose=verbose, jobs=jobs, progress=progress)
+    exact_items = index.exact_duplicates(verbose=verbose)
+    exact = {
+        digest: sorted(paths[i].name for i in items)
+        for digest, items in exact_items.items()
+    }
+    content = {i: digest for digest, items in exact_items.items() for i in items}
+
+    pairs = []
+    # pairs_within yields the pairs grouped by their first item: score each
+    # image against all its candidates at once
+    candidates = index.hashes.pairs_within(max_threshold)
+    for i, group in groupby(candidates, key=lambda c: c[0]):
+        js, dists = [], []
+        for _, j, dist in group:
+            # byte-identical pairs are already in `exact`
+            if i not in content or content.get(j) != content[i]:
+                js.append(j)
+                dists.append(dist)
+        scores = ssim_batch(index.thumbs([i])[0], index.thumbs(js))
+        for j, dist, score in zip(js, dists, scores.tolist()):
+            if score >= min_ssim:
+                pairs.append(SimilarPair(paths[i], paths[j], dist, score))
+        if progress is not None:
+            progress("comparing images", i + 1, len(paths))
+    if verbose:
+        print(
+            f"{len(pairs)} candidate pairs with hamming <= {max_threshold}, "
+            f"ssim >= {min_ssim} ({peak_memory(jobs)})"
+        )
+    return EdgeList(list(paths), exact, pairs, max_threshold, min_ssim)
+
+
+def print_pairs(pairs: Sequence[SimilarPair]) -> None:
+    for pair in pairs:
+        print(
+            f"  {pair.a.name} ~ {pair.b.name} "
+            f"(hamming {pair.hamming}, ssim {pair.ssim:.3f})"
+        )
+
+
+def find_duplicate_groups_from_paths(
+    paths: Sequence[Path],
+    threshold: int,
+    ssim_threshold: float,
+    verbose: bool = False,
+) -> tuple[dict[str, list[str]], list[SimilarPair]]:
+    """Return (exact duplicates by digest, similar pairs)."""
+    edges = scan_edges(paths, threshold, ssim_threshold, verbose=verbose)
+    pairs = edges.select(threshold, ssim_threshold)
+    if verbose:
+        print_pairs(pairs)
+    return edges.exact, pairs
+
+
+def bench_ssim(
+    counts: Sequence[int], candidates: int = 16, sample_size: int = 500
+) -> None:
+    """Compare ssim_batch with per-pair ssim on synthetic memory-mapped thumbnails.
+
+    Every image is scored against `candidates` others, as a scan does for the
+    images sharing hash blocks.
+    """
+    rng = np.random.default_rng(0)
+    for n in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            thumbs = np.memmap(
+                Path(tmp) / "thumbs.u8",
+                dtype=np.uint8,
+                mode="w+",
+                shape=(n, SSIM_SIZE, SSIM_SIZE),
+            )
+            # smooth random images, half of them noisy copies of the other half
+            base = rng.integers(0, 256, (n, 8, 8), dtype=np.uint8)
+            thumbs[:] = np.kron(base, np.ones((8, 8), dtype=np.uint8))
+            half = n // 2
+            noise = rng.integers(-20, 21, (n - half, SSIM_SIZE, SSIM_SIZE))
+            thumbs[half:] = np.clip(thumbs[: n - half] + noise, 0, 255)
+            others = rng.integers(0, n, (n, candidates))
+
+            start = time.perf_counter()
+            got = np.array([ssim_batch(thumbs[i], thumbs[others[i]]) for i in range(n)])
+            batch = time.perf_counter() - start
+            # the per-pair version is slow: run it on a sample, extrapolate
+            sample = min(n, sample_size)
+            start = time.perf_counter()
+            expected = np.array(
+                [[ssim(thumbs[i], thumbs[j]) for j in others[i]] for i in range(sample)]
+            )
+            per_pair = (time.perf_counter() - start) * n / sample
+            del thumbs
+        err = float(np.abs(got[:sample] - expected).max())
+        assert err <= SSIM_TOLERANCE, f"{n} images: max difference {err}"
+        print(
+            f"{n} images x {candidates} candidates: batch {batch:.2f}s, "
+            f"per pair {per_pair:.2f}s{'' if sample == n else ' (estimated)'} "
+            f"({per_pair / max(batch, 1e-9):.1f}x), max difference {err:.1e}"
+        )
+
+
+def main() -> None:
+    from dedup import DEDUP_SSIM_THRESHOLD, DEDUP_THRESHOLD, SITE_IMG_DIR
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser(
+        "query", help=f"Check whether images already exist in {SITE_IMG_DIR}"
+    )
+    query_parser.add_argument("images", nargs="+", type=Path, help="Images to look up")
+    query_parser.add_argument(
+        "--threshold",
+        type=int,
+        default=DEDUP_THRESHOLD,
+        help=f"Max Hamming distance (default: {DEDUP_THRESHOLD})",
+    )
+    query_parser.add_argument(
+        "--ssim-threshold",
+        type=float,
+        default=DEDUP_SSIM_THRESHOLD,
+        help=f"Min SSIM score (default: {DEDUP_SSIM_THRESHOLD})",
+    )
+    query_parser.set_defaults(
+        func=lambda args: query_images(
+            SITE_IMG_DIR, args.images, args.threshold, args.ssim_threshold
+        )
+    )
+    scan_parser = subparsers.add_parser(
+        "scan", help="Scan a directory of images, report time and peak memory"
+    )
+    scan_parser.add_argument(
+        "directory",
+        type=Path,
+        nargs="?",
+        default=SITE_IMG_DIR,
+        help=f"Directory of .jpeg images (default: {SITE_IMG_DIR})",
+    )
+    scan_parser.add_argument("--threshold", type=int, default=DEDUP_THRESHOLD)
+    scan_parser.add_argument(
+        "--ssim-threshold", type=float, default=DEDUP_SSIM_THRESHOLD
+    )
+    add_jobs_argument(scan_parser, "to decode images")
+    scan_parser.set_defaults(
+        func=lambda args: scan_directory(
+            args.directory, args.threshold, args.ssim_threshold, args.jobs
+        )
+    )
+    bench_parser = subparsers.add_parser(
+        "bench_ssim", help="Benchmark the batch SSIM against the per-pair one"
+    )
+    bench_parser.add_argument(
+        "--images",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="Number of images (default: 1000 10000)",
+    )
+    bench_parser.set_defaults(func=lambda args: bench_ssim(args.images))
+    args = parser.parse_args()
+    args.func(args)
+
+
+def scan_directory(
+    directory: Path, threshold: int, ssim_threshold: float, jobs: int = 1
+) -> None:
+    start = time.perf_counter()
+    edges = scan_edges(
+        sorted(directory.glob("*.jpeg")),
+        threshold,
+        ssim_threshold,
+        verbose=True,
+        jobs=jobs,
+    )
+    print(
+        f"{len(edges.paths)} images: {len(edges.exact)} exact groups, "
+        f"{len(edges.pairs)} similar pairs in {time.perf_counter() - start:.2f}s, "
+        f"{peak_memory(jobs)}"
+    )
+
+
+def query_images(
+    directory: Path, images: Sequence[Path], threshold: int, ssim_threshold: float
+) -> None:
+    index = ImageIndex(sorted(directory.glob("*.jpeg")))
+    found = False
+    for image in images:
+        matches = index.query(image, threshold, ssim_threshold)
+        if not matches:
+            print(f"{image}: new")
+            continue
+        found = True
+        print(f"{image}: duplicate of")
+        for m in matches:
+            print(f"  {m.b.name} (hamming {m.hamming}, ssim {m.ssim:.3f})")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,18 +7,27 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import heapq
+import random
+import tempfile
+import time
 
 import Levenshtein
+import numpy as np
 
-from difflib import ndiff
+from bisect import insort
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from argparse import RawTextHelpFormatter
 from dataclasses import dataclass
-from typing import Tuple, Protocol, Type, TypeVar, Generic, Sequence
+from typing import Tuple, Protocol, Type, TypeVar, Generic, Iterator, Sequence
 from urllib3.util.retry import Retry
 
 from requests.adapters import HTTPAdapter
 import diskcache
-from sqlmodel import Session, select, col
+from sqlmodel import Session, select, col, delete
 
 from models import (
     AfQuestion,
@@ -26,14 +35,34 @@ from models import (
     create_engine,
     PdfQuestion,
     AnnaleToAfMapping,
+    QuestionAlignment,
+    pair_fingerprint,
 )
 from log import SCRIPT_DIR
 from cache import CACHE
+from utils import add_jobs_argument
 
 #############
 # Constants #
 #############
 
+# size of the character n-grams used to prune nearest-match candidates
+QGRAM = 3
+
+# pairs nearer than this are linked without asking
+AUTO_LINK_DIST = 3
+# interactive link decisions are committed every LINK_BATCH answers
+LINK_BATCH = 10
+
+# candidate edges per question, and maximum distance of a match, when
+# aligning two sources one-to-one
+ALIGN_CANDIDATES = 5
+ALIGN_MAX_DIST = 20
+
+# diskcache key prefixes of the incremental nearest-match cache
+NEAREST_KEY = "nearest_v2"
+CORPUS_KEY = "nearest_corpus_v1"
+
 ########
 # Logs #
 ########
@@ -48,20 +77,20 @@ def colored_diff_lines(s1, s2):
     RED = "\033[91m"  # for deletions (s1)
     GREEN = "\033[92m"  # for additions (s2)
 
-    # diff by character
-    diff = list(ndiff(list(s1), list(s2)))
+    # diff by character, from the edit operations of the Levenshtein distance
     line1 = []
     line2 = []
 
-    for token in diff:
-        code, char = token[:2], token[2:]
-        if code == "  ":
-            line1.append(char)
-            line2.append(char)
-        elif code == "- ":
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(s1, s2):
+        if tag == "equal":
+            line1.append(s1[i1:i2])
+            line2.append(s2[j1:j2])
+            continue
+        # like ndiff, a replaced block is the deletions followed by the additions
+        for char in s1[i1:i2]:
             line1.append(f"{RED}{char}{RESET}")
             line2.append(" ")
-        elif code == "+ ":
+        for char in s2[j1:j2]:
             line1.append(" ")
             line2.append(f"{GREEN}{char}{RESET}")
 
@@ -89,42 +118,357 @@ class Diff(Generic[A, B]):
         )
 
 
-def compute_diffs_annale_af(
+def load_af_annale(
     engine,
-) -> dict[int, list[Diff[AfQuestion, AnnaleQuestion]]]:
+) -> tuple[Sequence[AfQuestion], Sequence[AnnaleQuestion]]:
     with Session(engine) as session:
-        # sorting needed for diskcache to work
+        # stable order, ties between equally near questions go to the last one
         a_s = session.exec(
             select(AfQuestion).order_by(col(AfQuestion.created_at))
         ).all()
         b_s = session.exec(
             select(AnnaleQuestion).order_by(col(AnnaleQuestion.created_at))
         ).all()
-        return compute_diffs(a_s, b_s)
+    return a_s, b_s
 
 
-def compute_diffs_annale_pdf(
+def compute_diffs_annale_af(
+    engine, jobs: int = 1
+) -> dict[int, list[Diff[AfQuestion, AnnaleQuestion]]]:
+    a_s, b_s = load_af_annale(engine)
+    return compute_diffs(a_s, b_s, jobs=jobs, comparison="af-annale")
+
+
+def load_annale_pdf(
     engine,
-) -> dict[int, list[Diff[AnnaleQuestion, PdfQuestion]]]:
+) -> tuple[Sequence[AnnaleQuestion], Sequence[PdfQuestion]]:
     with Session(engine) as session:
-        # sorting needed for diskcache to work
+        # stable order, ties between equally near questions go to the last one
         a_s = session.exec(
             select(AnnaleQuestion).order_by(col(AnnaleQuestion.created_at))
         ).all()
         b_s = session.exec(
             select(PdfQuestion).order_by(col(PdfQuestion.created_at))
         ).all()
-        return compute_diffs(a_s, b_s)
+    return a_s, b_s
 
 
-@CACHE.memoize(name="compute_diffs_v2")
-def compute_diffs(
+def compute_diffs_annale_pdf(
+    engine, jobs: int = 1
+) -> dict[int, list[Diff[AnnaleQuestion, PdfQuestion]]]:
+    a_s, b_s = load_annale_pdf(engine)
+    return compute_diffs(a_s, b_s, jobs=jobs, comparison="annale-pdf")
+
+
+def qgrams(s: str, q: int = QGRAM) -> Counter[str]:
+    return Counter(s[i : i + q] for i in range(len(s) - q + 1))
+
+
+class CandidateIndex:
+    """q-gram postings over a list of cleaned contents.
+
+    The Levenshtein distance between two strings is bounded from below by their
+    length difference, and by the number of q-grams they share (q-gram lemma:
+    one edit destroys at most q of the max(len) - q + 1 q-grams). Only the
+    candidates whose lower bound does not exceed the best distance found so far
+    get an exact `Levenshtein.distance`, so the nearest match is the same as
+    with a full scan.
+    """
+
+    def __init__(self, contents: Sequence[str], q: int = QGRAM) -> None:
+        self.contents = list(contents)
+        self.q = q
+        self.lens = np.array([len(s) for s in self.contents], dtype=np.int64)
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        for j, s in enumerate(self.contents):
+            for gram, count in qgrams(s, q).items():
+                idx, counts = postings.setdefault(gram, ([], []))
+                idx.append(j)
+                counts.append(count)
+        self.postings = {
+            gram: (np.array(idx, dtype=np.int64), np.array(counts, dtype=np.int64))
+            for gram, (idx, counts) in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    def lower_bounds(self, s: str) -> np.ndarray:
+        common = np.zeros(len(self.contents), dtype=np.int64)
+        for gram, count in qgrams(s, self.q).items():
+            posting = self.postings.get(gram)
+            if posting is not None:
+                idx, counts = posting  # a string appears once per posting
+                common[idx] += np.minimum(counts, count)
+        grams = np.maximum(np.maximum(self.lens, len(s)) - self.q + 1, 0)
+        qgram_bound = -((common - grams) // self.q)  # ceil((grams - common) / q)
+        return np.maximum(np.abs(self.lens - len(s)), qgram_bound)
+
+    def search(self, s: str, k: int = 1) -> list[tuple[int, int]]:
+        """Return (index, distance) of the k nearest contents, nearest first.
+
+        Candidates are visited by increasing lower bound while keeping the k
+        best so far: the search stops at the first bound (length difference
+        included) above the k-th best distance, and the exact distance of the
+        others is abandoned (`score_cutoff`) as soon as it cannot beat it.
+        Ties go to the last index, like the `min()` of the full scan."""
+        return self.search_spans(s, k, [(0, len(self.contents))])[0]
+
+    def search_spans(
+        self, s: str, k: int, spans: Sequence[tuple[int, int]]
+    ) -> list[list[tuple[int, int]]]:
+        """`search` within each [lo, hi) span of the contents.
+
+        The lower bounds are computed once for all spans, so one index over
+        several sources answers the nearest match in each of them."""
+        bounds = self.lower_bounds(s)
+        return [self._search_span(s, k, bounds, lo, hi) for lo, hi in spans]
+
+    def _search_span(
+        self, s: str, k: int, bounds: np.ndarray, lo: int, hi: int
+    ) -> list[tuple[int, int]]:
+        span = bounds[lo:hi]
+        order = np.argsort(span, kind="stable")
+        best: list[tuple[int, int]] = []  # sorted (distance, -index)
+        for j, bound in zip((order + lo).tolist(), span[order].tolist()):
+            cutoff = best[-1][0] if len(best) == k else None
+            if cutoff is not None and bound > cutoff:
+                break
+            dist = Levenshtein.distance(s, self.contents[j], score_cutoff=cutoff)
+            if cutoff is not None and dist > cutoff:
+                continue
+            insort(best, (dist, -j))
+            del best[k:]
+        return [(-neg_j, dist) for dist, neg_j in best]
+
+    def nearest(self, s: str) -> tuple[int, int]:
+        """Return (index, distance) of the nearest content."""
+        return self.search(s, k=1)[0]
+
+
+# index of the current worker process, see `nearest_matches`
+_WORKER_INDEX: CandidateIndex | None = None
+
+
+def _init_worker(contents: list[str]) -> None:
+    global _WORKER_INDEX
+    _WORKER_INDEX = CandidateIndex(contents)
+
+
+def _search_chunk(
+    k: int, spans: list[tuple[int, int]], contents: list[str]
+) -> list[list[list[tuple[int, int]]]]:
+    assert _WORKER_INDEX is not None
+    return [_WORKER_INDEX.search_spans(s, k, spans) for s in contents]
+
+
+def iter_search_spans(
+    a_contents: Sequence[str],
+    b_contents: Sequence[str],
+    spans: Sequence[tuple[int, int]],
+    k: int = 1,
+    jobs: int = 1,
+) -> Iterator[list[list[tuple[int, int]]]]:
+    """Yield the (index, distance) of the k nearest b's in each span, for each
+    a in order.
+
+    With jobs > 1 the a's are sharded in contiguous chunks across worker
+    processes, each holding its own index over the b's. `map` keeps the chunks
+    in order, so the result does not depend on the number of workers."""
+    if jobs <= 1 or len(a_contents) < 2:
+        index = CandidateIndex(b_contents)
+        for s in a_contents:
+            yield index.search_spans(s, k, spans)
+        return
+    # a few chunks per worker, so that a slow chunk does not stall the pool
+    size = max(1, -(-len(a_contents) // (jobs * 4)))
+    chunks = [list(a_contents[i : i + size]) for i in range(0, len(a_contents), size)]
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(list(b_contents),)
+    ) as pool:
+        for chunk in pool.map(partial(_search_chunk, k, list(spans)), chunks):
+            yield from chunk
+
+
+def iter_search_matches(
+    a_contents: Sequence[str], b_contents: Sequence[str], k: int = 1, jobs: int = 1
+) -> Iterator[list[tuple[int, int]]]:
+    """Yield the (index, distance) of the k nearest b's for each a, in order."""
+    spans = [(0, len(b_contents))]
+    for matches in iter_search_spans(a_contents, b_contents, spans, k, jobs):
+        yield matches[0]
+
+
+def search_matches(
+    a_contents: Sequence[str], b_contents: Sequence[str], k: int = 1, jobs: int = 1
+) -> list[list[tuple[int, int]]]:
+    return list(iter_search_matches(a_contents, b_contents, k, jobs))
+
+
+def nearest_matches(
+    a_contents: Sequence[str], b_contents: Sequence[str], jobs: int = 1
+) -> list[tuple[int, int]]:
+    """Return the (index, distance) of the nearest b for each a, in order."""
+    return [m[0] for m in search_matches(a_contents, b_contents, k=1, jobs=jobs)]
+
+
+def iter_top_diffs(
+    a_s: Sequence[A],
+    b_s: Sequence[B],
+    k: int = 3,
+    jobs: int = 1,
+) -> Iterator[list[Diff]]:
+    """Yield the k nearest b's of each a as diffs, nearest first.
+
+    The first diff is the one `compute_diffs` keeps, the others are the
+    runner-up matches. Each a is yielded as soon as its search is done."""
+    matches = iter_search_matches(
+        [a.clean_content() for a in a_s], [b.clean_content() for b in b_s], k, jobs
+    )
+    for a, a_matches in zip(a_s, matches):
+        yield [Diff(ids=(a, b_s[j]), leven_dist=dist) for j, dist in a_matches]
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    partial: int = 0  # refreshed against the questions added since
+    misses: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"nearest-match cache: {self.hits} hits, {self.partial} partial, "
+            f"{self.misses} misses"
+        )
+
+
+NEAREST_STATS = CacheStats()
+
+
+def content_digest(s: str) -> str:
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def cached_nearest_matches(
+    a_contents: Sequence[str],
+    b_contents: Sequence[str],
+    jobs: int = 1,
+    *,
+    comparison: str,
+) -> list[tuple[int, int]]:
+    """`nearest_matches`, cached per comparison and per a by digest of its
+    cleaned content.
+
+    An entry holds the digest of the best b and the fingerprint of the b's it
+    was searched in. If that best b is still there and the b's kept since
+    are in the same relative order (ties go to the last b), the entry is
+    refreshed by searching the added b's alone; a new or edited a, a removed
+    (copy of the) best b, or reordered b's (created_at) are a full miss."""
+    b_digests = [content_digest(s) for s in b_contents]
+    corpus = content_digest("\n".join(b_digests))
+    CACHE.add((CORPUS_KEY, corpus), b_digests)
+    last_index = {digest: j for j, digest in enumerate(b_digests)}
+    a_digests = [content_digest(s) for s in a_contents]
+
+    res: list[tuple[int, int] | None] = [None] * len(a_contents)
+    known: dict[int, tuple[int, int]] = {}
+    known_digest: dict[int, str] = {}
+    stale: dict[str, list[int]] = {}  # old corpus -> positions in a_contents
+    misses: list[int] = []
+    for i, digest in enumerate(a_digests):
+        entry = CACHE.get((NEAREST_KEY, comparison, digest))
+        if entry is None or entry[1] not in last_index:
+            misses.append(i)
+            continue
+        entry_corpus, b_digest, dist = entry
+        known[i] = (last_index[b_digest], dist)
+        known_digest[i] = b_digest
+        if entry_corpus == corpus:
+            res[i] = known[i]
+        else:
+            stale.setdefault(entry_corpus, []).append(i)
+    NEAREST_STATS.hits += len(known) - sum(len(p) for p in stale.values())
+
+    for old_corpus, positions in stale.items():
+        old = CACHE.get((CORPUS_KEY, old_corpus))
+        if old is None:
+            misses.extend(positions)
+            continue
+        # a copy of an old content is added too: it may win a tie by coming last
+        remaining = Counter(old)
+        added, kept = [], []
+        for j, digest in enumerate(b_digests):
+            if remaining[digest] > 0:
+                remaining[digest] -= 1
+                kept.append(digest)
+            else:
+                added.append(j)
+        # the old best b only still wins its ties if the kept b's did not move
+        old_order = iter(old)
+        if not all(digest in old_order for digest in kept):
+            misses.extend(positions)
+            continue
+        # what is left in remaining was removed, ties with the best b may change
+        removed = [i for i in positions if remaining[known_digest[i]] > 0]
+        misses.extend(removed)
+        positions = [i for i in positions if remaining[known_digest[i]] == 0]
+        found = (
+            nearest_matches(
+                [a_contents[i] for i in positions],
+                [b_contents[j] for j in added],
+                jobs,
+            )
+            if added
+            else [(-1, -1)] * len(positions)
+        )
+        for i, (k, dist) in zip(positions, found):
+            candidates = [known[i]] + ([(added[k], dist)] if k >= 0 else [])
+            res[i] = min(candidates, key=lambda m: (m[1], -m[0]))
+        NEAREST_STATS.partial += len(positions)
+
+    misses.sort()
+    found = nearest_matches([a_contents[i] for i in misses], b_contents, jobs)
+    for i, match in zip(misses, found):
+        res[i] = match
+    NEAREST_STATS.misses += len(misses)
+
+    with CACHE.transact():
+        for i, match in enumerate(res):
+            assert match is not None
+            CACHE.set(
+                (NEAREST_KEY, comparison, a_digests[i]),
+                (corpus, b_digests[match[0]], match[1]),
+            )
+    return res  # type: ignore[return-value]
+
+
+def diffs_by_distance(
+    a_s: Sequence[A], b_s: Sequence[B], matches: Sequence[tuple[int, int]]
+) -> dict[int, list[Diff]]:
+    res: dict[int, list[Diff]] = {}
+    for a, (j, dist) in zip(a_s, matches):
+        res.setdefault(dist, []).append(Diff(ids=(a, b_s[j]), leven_dist=dist))
+    return res
+
+
+def nearest_diffs(
+    a_s: Sequence[A],
+    b_s: Sequence[B],
+    jobs: int = 1,
+) -> dict[int, list[Diff]]:
+    matches = nearest_matches(
+        [a.clean_content() for a in a_s], [b.clean_content() for b in b_s], jobs
+    )
+    return diffs_by_distance(a_s, b_s, matches)
+
+
+def brute_force_diffs(
     a_s: Sequence[A],
     b_s: Sequence[B],
 ) -> dict[int, list[Diff]]:
+    """Reference N×M scan, kept for `bench_compute_diffs`."""
     res: dict[int, list[Diff]] = {}
-    assert len(a_s) <= len(b_s)
-    for a in a_s:  # it's important to have af in outer loop as they're fewer of them
+    for a in a_s:
         min_diff: Diff | None = None
         for b in b_s:
             diff = Diff.new(a, b)
@@ -136,74 +480,507 @@ def compute_diffs(
     return res
 
 
-def check_identicals(engine) -> None:
-    res = compute_diffs_annale_af(engine)
+def compute_diffs(
+    a_s: Sequence[A],
+    b_s: Sequence[B],
+    jobs: int = 1,
+    *,
+    comparison: str,
+) -> dict[int, list[Diff]]:
+    assert len(a_s) <= len(b_s)
+    # it's important to have af in outer loop as they're fewer of them
+    matches = cached_nearest_matches(
+        [a.clean_content() for a in a_s],
+        [b.clean_content() for b in b_s],
+        jobs,
+        comparison=comparison,
+    )
+    return diffs_by_distance(a_s, b_s, matches)
+
+
+def diff_ids(res: dict[int, list[Diff]]) -> dict[int, list[tuple[str, str]]]:
+    return {
+        k: [(d.ids[0].question_id, d.ids[1].question_id) for d in diffs]
+        for k, diffs in res.items()
+    }
+
+
+def bench_compute_diffs(engine, jobs: int = 1) -> None:
+    """Compare the pruned nearest-match search with the full N×M scan."""
+    with Session(engine) as session:
+        af_s = session.exec(
+            select(AfQuestion).order_by(col(AfQuestion.created_at))
+        ).all()
+        annale_s = session.exec(
+            select(AnnaleQuestion).order_by(col(AnnaleQuestion.created_at))
+        ).all()
+        pdf_s = session.exec(
+            select(PdfQuestion).order_by(col(PdfQuestion.created_at))
+        ).all()
+    for label, a_s, b_s in [
+        ("af/annale", af_s, annale_s),
+        ("annale/pdf", annale_s, pdf_s),
+    ]:
+        if not a_s or not b_s:
+            print(f"{label}: no questions, skipping")
+            continue
+        start = time.perf_counter()
+        expected = brute_force_diffs(a_s, b_s)
+        brute = time.perf_counter() - start
+        start = time.perf_counter()
+        got = nearest_diffs(a_s, b_s)
+        pruned = time.perf_counter() - start
+        assert diff_ids(got) == diff_ids(expected), f"{label}: results differ"
+        print(
+            f"{label} ({len(a_s)}×{len(b_s)}): full scan {brute:.2f}s, "
+            f"candidate index {pruned:.2f}s ({brute / max(pruned, 1e-9):.1f}x)"
+        )
+        if jobs > 1:
+            start = time.perf_counter()
+            got = nearest_diffs(a_s, b_s, jobs=jobs)
+            parallel = time.perf_counter() - start
+            assert diff_ids(got) == diff_ids(expected), f"{label}: results differ"
+            print(f"{label}: candidate index with {jobs} jobs {parallel:.2f}s")
+
+
+@dataclass
+class _Text:
+    question_id: str
+    content: str
+
+    def clean_content(self) -> str:
+        return self.content
+
+
+def _edit_questions(rng: random.Random, texts: list[str], word) -> list[str]:
+    texts = list(texts)
+    edit = rng.choice(["add", "copy", "remove", "swap", "shuffle"])
+    if edit == "add":
+        texts.insert(rng.randint(0, len(texts)), word())
+    elif edit == "copy":
+        texts.insert(rng.randint(0, len(texts)), rng.choice(texts))
+    elif edit == "remove" and len(texts) > 1:
+        texts.pop(rng.randrange(len(texts)))
+    elif edit == "swap":
+        i, j = rng.randrange(len(texts)), rng.randrange(len(texts))
+        texts[i], texts[j] = texts[j], texts[i]
+    elif edit == "shuffle":
+        rng.shuffle(texts)
+    return texts
+
+
+def check_nearest_cache(engine, jobs: int = 1, rounds: int = 500) -> None:
+    """Compare the cached nearest-match search with the full N×M scan over
+    random additions, copies, removals and reorders of the questions, in a
+    throwaway cache."""
+    global CACHE
+    rng = random.Random(0)
+
+    def word() -> str:
+        return "".join(rng.choice("abc") for _ in range(rng.randint(1, 5)))
+
+    saved = CACHE
+    with tempfile.TemporaryDirectory() as directory:
+        CACHE = diskcache.Cache(directory)
+        try:
+            for _ in range(rounds):
+                a_s = [word() for _ in range(rng.randint(1, 6))]
+                b_s = [word() for _ in range(rng.randint(1, 10))]
+                for _ in range(5):
+                    got = cached_nearest_matches(a_s, b_s, jobs, comparison="check")
+                    # the same a's compared with other b's must not share entries
+                    other = [word() for _ in range(3)]
+                    cached_nearest_matches(a_s, other, jobs, comparison="other")
+                    a_texts = [_Text(f"a{i}", t) for i, t in enumerate(a_s)]
+                    b_texts = [_Text(f"b{j}", t) for j, t in enumerate(b_s)]
+                    expected = brute_force_diffs(a_texts, b_texts)
+                    assert diff_ids(
+                        diffs_by_distance(a_texts, b_texts, got)
+                    ) == diff_ids(expected), f"{a_s} / {b_s}: results differ"
+                    b_s = _edit_questions(rng, b_s, word)
+                    if rng.random() < 0.2:
+                        a_s = _edit_questions(rng, a_s, word)
+        finally:
+            CACHE.close()
+            CACHE = saved
+    print(f"nearest-match cache agrees with the full scan ({NEAREST_STATS})")
+
+
+def min_cost_matching(
+    edges: Sequence[Sequence[tuple[int, int]]], unmatched_cost: int
+) -> list[int | None]:
+    """Return the b matched to each a, minimizing the total cost.
+
+    edges[i] lists the (j, cost) candidate b's of a i. Each b is matched at
+    most once, and an a left unmatched costs `unmatched_cost`. Successive
+    shortest augmenting paths (Dijkstra with potentials) over the candidate
+    edges only, so the work follows the number of edges rather than N×M."""
+    n = len(edges)
+    # columns are the b indices, plus a private "unmatched" column -1 - i per a
+    row_pot = [0] * n
+    col_pot: dict[int, int] = {}
+    match_row: list[int | None] = [None] * n
+    match_col: dict[int, int] = {}
+    for r0 in range(n):
+        dist_row = {r0: 0}
+        dist_col: dict[int, int] = {}
+        pred: dict[int, int] = {}
+        done: set[int] = set()
+        heap: list[tuple[int, int]] = []
+
+        def relax(r: int, d: int) -> None:
+            for c, cost in [*edges[r], (-1 - r, unmatched_cost)]:
+                nd = d + cost + row_pot[r] - col_pot.get(c, 0)
+                if nd < dist_col.get(c, nd + 1):
+                    dist_col[c] = nd
+                    pred[c] = r
+                    heapq.heappush(heap, (nd, c))
+
+        relax(r0, 0)
+        while True:
+            d, c = heapq.heappop(heap)
+            if c in done or d > dist_col[c]:
+                continue
+            done.add(c)
+            if c not in match_col:
+                end, total = c, d
+                break
+            r = match_col[c]
+            dist_row[r] = d  # matched edges have a zero reduced cost
+            relax(r, d)
+        # keep the reduced costs non-negative (shifted by -total, which cancels)
+        for r, d in dist_row.items():
+            row_pot[r] += d - total
+        for c in done:
+            col_pot[c] = col_pot.get(c, 0) + dist_col[c] - total
+        c = end
+        while True:
+            r = pred[c]
+            previous = match_row[r]
+            match_row[r] = c
+            match_col[c] = r
+            if r == r0:
+                break
+            assert previous is not None
+            c = previous
+    return [c if c is not None and c >= 0 else None for c in match_row]
+
+
+@dataclass(frozen=True)
+class Alignment(Generic[A, B]):
+    a: A
+    b: B | None  # None if left unmatched
+    leven_dist: int | None
+    nearest: Diff[A, B]  # what compute_diffs picks for a
+
+
+def align(
+    a_s: Sequence[A],
+    b_s: Sequence[B],
+    k: int = ALIGN_CANDIDATES,
+    max_dist: int = ALIGN_MAX_DIST,
+    jobs: int = 1,
+) -> list[Alignment[A, B]]:
+    """Globally consistent one-to-one matching of a_s to b_s.
+
+    The candidate edges of each a are its k nearest b's within max_dist, and
+    the matching minimizes the sum of their distances, an unmatched a costing
+    max_dist + 1."""
+    matches = search_matches(
+        [a.clean_content() for a in a_s], [b.clean_content() for b in b_s], k, jobs
+    )
+    res = []
+    for a, a_matches, match in zip(a_s, matches, match_one_to_one(matches, max_dist)):
+        nearest_j, nearest_dist = a_matches[0]
+        res.append(
+            Alignment(
+                a=a,
+                b=b_s[match[0]] if match is not None else None,
+                leven_dist=match[1] if match is not None else None,
+                nearest=Diff(ids=(a, b_s[nearest_j]), leven_dist=nearest_dist),
+            )
+        )
+    return res
+
+
+def match_one_to_one(
+    matches: Sequence[Sequence[tuple[int, int]]], max_dist: int
+) -> list[tuple[int, int] | None]:
+    """Return the (index, distance) each a is aligned to, given its candidates."""
+    edges = [[(j, dist) for j, dist in m if dist <= max_dist] for m in matches]
+    matching = min_cost_matching(edges, unmatched_cost=max_dist + 1)
+    return [
+        (j, dict(a_edges)[j]) if j is not None else None
+        for a_edges, j in zip(edges, matching)
+    ]
+
+
+def align_all(engine, jobs: int = 1) -> None:
+    """Align each AnnaleQuestion to an AfQuestion and a PdfQuestion in one pass.
+
+    One candidate index covers both AF and PDF questions, each annale is
+    searched once in it, then each source is matched one-to-one. The result
+    replaces the QuestionAlignment table."""
+    start = time.perf_counter()
+    with Session(engine) as session:
+        annale_s = session.exec(
+            select(AnnaleQuestion).order_by(col(AnnaleQuestion.created_at))
+        ).all()
+        af_s = session.exec(
+            select(AfQuestion).order_by(col(AfQuestion.created_at))
+        ).all()
+        pdf_s = session.exec(
+            select(PdfQuestion).order_by(col(PdfQuestion.created_at))
+        ).all()
+    others = [*af_s, *pdf_s]
+    spans = [(0, len(af_s)), (len(af_s), len(others))]
+    matches = list(
+        iter_search_spans(
+            [a.clean_content() for a in annale_s],
+            [o.clean_content() for o in others],
+            spans,
+            ALIGN_CANDIDATES,
+            jobs,
+        )
+    )
+    af_matching = match_one_to_one([m[0] for m in matches], ALIGN_MAX_DIST)
+    pdf_matching = match_one_to_one(
+        [[(j - len(af_s), dist) for j, dist in m[1]] for m in matches], ALIGN_MAX_DIST
+    )
+
+    rows = []
+    for annale, af_match, pdf_match in zip(annale_s, af_matching, pdf_matching):
+        af = af_s[af_match[0]] if af_match is not None else None
+        pdf = pdf_s[pdf_match[0]] if pdf_match is not None else None
+        answers = [
+            q.answer for q in (af, pdf) if q is not None and q.answer is not None
+        ]
+        rows.append(
+            QuestionAlignment(
+                annale_question_id=annale.question_id,
+                af_question_id=af.question_id if af is not None else None,
+                af_leven_dist=af_match[1] if af_match is not None else None,
+                pdf_question_id=pdf.question_id if pdf is not None else None,
+                pdf_leven_dist=pdf_match[1] if pdf_match is not None else None,
+                annale_answer=annale.answer,
+                af_answer=af.answer if af is not None else None,
+                pdf_answer=pdf.answer if pdf is not None else None,
+                answers_agree=(
+                    all(answer == annale.answer for answer in answers)
+                    if answers
+                    else None
+                ),
+            )
+        )
+    disagreements = sum(r.answers_agree is False for r in rows)
+    with Session(engine) as session:
+        session.exec(delete(QuestionAlignment))  # type: ignore[call-overload]
+        session.add_all(rows)
+        session.commit()
+    print(
+        f"Aligned {len(rows)} annale questions: "
+        f"{sum(m is not None for m in af_matching)} to AF, "
+        f"{sum(m is not None for m in pdf_matching)} to PDF, "
+        f"{disagreements} answer disagreements "
+        f"({time.perf_counter() - start:.2f}s)"
+    )
+
+
+def align_sources(
+    engine,
+    source: str,
+    k: int = ALIGN_CANDIDATES,
+    max_dist: int = ALIGN_MAX_DIST,
+    jobs: int = 1,
+) -> None:
+    if source == "af-annale":
+        a_s, b_s = load_af_annale(engine)
+    else:
+        a_s, b_s = load_annale_pdf(engine)
+    alignments = align(a_s, b_s, k=k, max_dist=max_dist, jobs=jobs)
+
+    # several a's whose nearest b is the same one
+    claims: dict[str, list[Alignment]] = {}
+    for al in alignments:
+        claims.setdefault(al.nearest.ids[1].question_id, []).append(al)
+    conflicts = {b_id: als for b_id, als in claims.items() if len(als) > 1}
+    for b_id, als in sorted(conflicts.items()):
+        print(f"\n--- {b_id} is the nearest match of {len(als)} questions ---")
+        for al in als:
+            got = (
+                f"{al.b.question_id} (distance {al.leven_dist})"
+                if al.b is not None
+                else "unmatched"
+            )
+            print(
+                f"  {al.a.question_id}: nearest distance {al.nearest.leven_dist}"
+                f" -> aligned to {got}"
+            )
+
+    matched = [al for al in alignments if al.b is not None]
+    moved = [
+        al
+        for al in matched
+        if al.b is not None and al.b.question_id != al.nearest.ids[1].question_id
+    ]
+    print(
+        f"\n{source}: {len(matched)}/{len(alignments)} aligned one-to-one "
+        f"(distance <= {max_dist}, total {sum(al.leven_dist or 0 for al in matched)}), "
+        f"{len(conflicts)} double nearest matches, "
+        f"{len(moved)} questions aligned to another than their nearest"
+    )
+
+
+def check_identicals(engine, jobs: int = 1) -> None:
+    res = compute_diffs_annale_af(engine, jobs)
     for k in sorted(res.keys()):
         print(f"levenshtein distance: {k}, number of questions {len(res[k])}")
 
 
 def do_link(
-    session: Session, af: AfQuestion, annale: AnnaleQuestion, is_same: bool
+    session: Session,
+    af: AfQuestion,
+    annale: AnnaleQuestion,
+    is_same: bool,
+    leven_dist: int,
 ) -> None:
     mapping = AnnaleToAfMapping(
         annale_question_id=annale.question_id,
         af_question_id=af.question_id,
         is_same=is_same,
+        leven_dist=leven_dist,
+        content_fingerprint=pair_fingerprint(af, annale),
     )
     session.add(mapping)
 
 
-def link_af_to_annale(engine) -> None:
-    res = compute_diffs_annale_af(engine)
-    for k in sorted(res.keys()):
-        print(
-            f"\n\n=== Levenshtein distance: {k}, number of questions {len(res[k])} ==="
-        )
-        for diff in res[k]:
-            af, annale = diff.ids
-            with Session(engine) as session:
-                if session.get(AnnaleToAfMapping, annale.question_id) is not None:
+def link_af_to_annale(engine, jobs: int = 1) -> None:
+    start = time.perf_counter()
+    res = compute_diffs_annale_af(engine, jobs)
+    print(f"[timing] nearest matches: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    with Session(engine) as session:
+        linked = set(session.exec(select(AnnaleToAfMapping.annale_question_id)).all())
+    print(
+        f"[timing] prefetched {len(linked)} existing mappings: "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+
+    start = time.perf_counter()
+    auto = 0
+    with Session(engine) as session:
+        for k in sorted(res.keys()):
+            if k >= AUTO_LINK_DIST:
+                break
+            for diff in res[k]:
+                af, annale = diff.ids
+                if annale.question_id in linked:
+                    continue
+                do_link(session, af, annale, is_same=True, leven_dist=diff.leven_dist)
+                linked.add(annale.question_id)
+                auto += 1
+        session.commit()
+    print(
+        f"[timing] auto-linked {auto} pairs with distance < {AUTO_LINK_DIST}: "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+
+    # answers are committed in batches: quitting (ctrl-c / ctrl-d) keeps what
+    # was answered, and the next run resumes after the already linked pairs
+    start = time.perf_counter()
+    answered = 0
+    with Session(engine) as session:
+        try:
+            for k in sorted(res.keys()):
+                if k < AUTO_LINK_DIST:
                     continue
-            if k < 3:
-                link = True
-            else:
                 print(
-                    f"\n--- AfQuestion ID: {af.question_id} | AnnaleQuestion ID: {annale.question_id} ---"
+                    f"\n\n=== Levenshtein distance: {k}, number of questions {len(res[k])} ==="
                 )
-                af_diff, annale_diff = colored_diff_lines(
-                    af.clean_content(), annale.clean_content()
-                )
-                print("af:     |", af_diff)
-                print("annale  |", annale_diff)
-                ans = input("Link these questions? (y/n) ")
-                link = ans.lower() == "y"
-            with Session(engine) as session:
-                do_link(session, af, annale, is_same=link)
-                session.commit()
+                for diff in res[k]:
+                    af, annale = diff.ids
+                    if annale.question_id in linked:
+                        continue
+                    print_af_annale_diff(diff)
+                    ans = input("Link these questions? (y/n) ")
+                    do_link(
+                        session,
+                        af,
+                        annale,
+                        is_same=ans.lower() == "y",
+                        leven_dist=diff.leven_dist,
+                    )
+                    linked.add(annale.question_id)
+                    answered += 1
+                    if answered % LINK_BATCH == 0:
+                        session.commit()
+        except (KeyboardInterrupt, EOFError):
+            print("\nInterrupted, saving the answered pairs")
+        finally:
+            session.commit()
+    print(
+        f"[timing] reviewed {answered} pairs interactively: "
+        f"{time.perf_counter() - start:.2f}s"
+    )
 
 
-def sub_show_diffs(engine, min_leven_dist: int) -> None:
-    res = compute_diffs_annale_af(engine)
+def print_af_annale_diff(
+    diff: Diff[AfQuestion, AnnaleQuestion], runner_ups: Sequence[Diff] = ()
+) -> None:
+    af, annale = diff.ids
+    print(
+        f"\n--- AfQuestion ID: {af.question_id} | AnnaleQuestion ID: {annale.question_id} ---"
+    )
+    af_diff, annale_diff = colored_diff_lines(
+        af.clean_content(), annale.clean_content()
+    )
+    print("af:     |", af_diff)
+    print("annale  |", annale_diff)
+    for other in runner_ups:
+        print(
+            f"runner-up: AnnaleQuestion ID: {other.ids[1].question_id} "
+            f"(distance {other.leven_dist})"
+        )
+
+
+def sub_show_diffs(
+    engine,
+    min_leven_dist: int,
+    jobs: int = 1,
+    runner_ups: int = 0,
+    stream: bool = False,
+) -> None:
     print(f"\nShowing diffs with minimum Levenshtein distance of {min_leven_dist}:\n")
+    if stream:
+        # printed as soon as computed, in AfQuestion order instead of by distance
+        a_s, b_s = load_af_annale(engine)
+        for diffs in iter_top_diffs(a_s, b_s, k=runner_ups + 1, jobs=jobs):
+            if diffs[0].leven_dist >= min_leven_dist:
+                print(f"\n=== Levenshtein distance: {diffs[0].leven_dist} ===")
+                print_af_annale_diff(diffs[0], diffs[1:])
+        return
+    others: dict[str, list[Diff]] = {}
+    if runner_ups > 0:
+        # a single k-nearest search gives both the match and its runner-ups
+        res: dict[int, list[Diff]] = {}
+        a_s, b_s = load_af_annale(engine)
+        for diffs in iter_top_diffs(a_s, b_s, k=runner_ups + 1, jobs=jobs):
+            res.setdefault(diffs[0].leven_dist, []).append(diffs[0])
+            others[diffs[0].ids[0].question_id] = diffs[1:]
+    else:
+        res = compute_diffs_annale_af(engine, jobs)
     for k in sorted(res.keys()):
         if k >= min_leven_dist:
             print(
                 f"\n\n=== Levenshtein distance: {k}, number of questions {len(res[k])} ==="
             )
             for diff in res[k]:
-                af, annale = diff.ids
-                print(
-                    f"\n--- AfQuestion ID: {af.question_id} | AnnaleQuestion ID: {annale.question_id} ---"
-                )
-                af_diff, annale_diff = colored_diff_lines(
-                    af.clean_content(), annale.clean_content()
-                )
-                print("af:     |", af_diff)
-                print("annale  |", annale_diff)
+                print_af_annale_diff(diff, others.get(diff.ids[0].question_id, []))
 
 
-def show_diffs_pdf(engine) -> None:
-    res = compute_diffs_annale_pdf(engine)
+def show_diffs_pdf(engine, jobs: int = 1) -> None:
+    res = compute_diffs_annale_pdf(engine, jobs)
     print("\nShowing diffs between PDF and Annale:\n")
     for k in sorted(res.keys()):
         if k <= 3:
@@ -226,14 +1003,24 @@ def show_diffs_pdf(engine) -> None:
     with Session(engine) as session:
         a_s = session.exec(select(AnnaleQuestion)).all()
         b_s = session.exec(select(PdfQuestion)).all()
+        alignments = session.exec(select(QuestionAlignment)).all()
     a_dict = {a.question_id: a for a in a_s}
     b_dict = {b.question_id: b for b in b_s}
+    # PDF question of each annale question: from `run align_all` if it was run,
+    # else the one with the same id
+    if alignments:
+        pdf_of = {al.annale_question_id: al.pdf_question_id for al in alignments}
+    else:
+        pdf_of = {a_id: a_id for a_id in a_dict}
     i = 0
     for a_id, a in a_dict.items():
-        if b_dict[a_id].answer != a.answer:
+        b_id = pdf_of.get(a_id)
+        if b_id is None:
+            continue
+        if b_dict[b_id].answer != a.answer:
             i += 1
             print(
-                f"Answer mismatch for question ID {a_id}: Annale answer {a.answer}, PDF answer {b_dict[a_id].answer}"
+                f"Answer mismatch for question ID {a_id}: Annale answer {a.answer}, PDF answer {b_dict[b_id].answer}"
             )
             print(a.content)
             print()
@@ -257,6 +1044,9 @@ def main() -> None:
         "check_identicals": check_identicals,
         "show_diffs_pdf": show_diffs_pdf,
         "link_af_to_annale": link_af_to_annale,
+        "bench_compute_diffs": bench_compute_diffs,
+        "check_nearest_cache": check_nearest_cache,
+        "align_all": align_all,
     }
     run_subparser = subparsers.add_parser("run", help="Run a command")
     run_subparser.add_argument(
@@ -264,7 +1054,10 @@ def main() -> None:
         choices=commands.keys(),
         help="Command to run",
     )
-    run_subparser.set_defaults(func=lambda args: commands[args.command](engine))
+    add_jobs_argument(run_subparser, "for the nearest-match search")
+    run_subparser.set_defaults(
+        func=lambda args: commands[args.command](engine, jobs=args.jobs)
+    )
     # sub parser for compute_diffs
     diff_subparser = subparsers.add_parser(
         "show_diffs", help="Compute diffs between AnnaleQuestion and AfQuestion"
@@ -275,9 +1068,57 @@ def main() -> None:
         default=3,
         help="Minimum Levenshtein distance to show diffs for",
     )
-    diff_subparser.set_defaults(func=lambda args: sub_show_diffs(engine, args.leven))
+    diff_subparser.add_argument(
+        "--runner-ups",
+        type=int,
+        default=0,
+        help="Also list the next N nearest AnnaleQuestions of each AfQuestion",
+    )
+    diff_subparser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Print each diff as soon as it is computed, in AfQuestion order",
+    )
+    add_jobs_argument(diff_subparser, "for the nearest-match search")
+    diff_subparser.set_defaults(
+        func=lambda args: sub_show_diffs(
+            engine,
+            args.leven,
+            jobs=args.jobs,
+            runner_ups=args.runner_ups,
+            stream=args.stream,
+        )
+    )
+    align_subparser = subparsers.add_parser(
+        "align",
+        help="One-to-one alignment between two sources, reporting double matches",
+    )
+    align_subparser.add_argument(
+        "source", choices=["af-annale", "annale-pdf"], help="Sources to align"
+    )
+    align_subparser.add_argument(
+        "--candidates",
+        type=int,
+        default=ALIGN_CANDIDATES,
+        help=f"Nearest candidates kept per question (default: {ALIGN_CANDIDATES})",
+    )
+    align_subparser.add_argument(
+        "--max-dist",
+        type=int,
+        default=ALIGN_MAX_DIST,
+        help=f"Maximum Levenshtein distance of a match (default: {ALIGN_MAX_DIST})",
+    )
+    add_jobs_argument(align_subparser, "for the nearest-match search")
+    align_subparser.set_defaults(
+        func=lambda args: align_sources(
+            engine, args.source, args.candidates, args.max_dist, jobs=args.jobs
+        )
+    )
     args = parser.parse_args()
     args.func(args)
+    if NEAREST_STATS != CacheStats():
+        print(NEAREST_STATS)
 
 
 ########
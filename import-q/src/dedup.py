@@ -5,7 +5,7 @@
 """Image deduplication review for the BIA annales.
 
 Holds the duplicate-image machinery used by gen-csv.py:
-- decision cache helpers (in a dedicated diskcache)
+- decision store (in memory, written through to a dedicated diskcache)
 - applying canonical decisions to the database and the annales TSV
 - a small local FastAPI app to review duplicate image groups
   (transitive closure of similar pairs: A~B and B~C => one group A,B,C)
@@ -16,31 +16,49 @@ from __future__ import annotations
 import csv
 import html
 import io
+import threading
 
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Sequence
+from typing import Iterator, Mapping, Sequence
+from urllib.parse import urlencode
 
 from fastapi import FastAPI, Query, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, Response
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from sqlalchemy import case, update
 from sqlmodel import Session, select, col
 
 from PIL import Image, ImageOps
 
 from models import ConsolidatedQuestion, ImageDedupDecision
-from check_imgs import SimilarPair, find_duplicate_groups_from_paths
-from cache import DECISIONS
+from check_imgs import EdgeList, Progress, SimilarPair, print_pairs, scan_edges
+from cache import DECISIONS, DEDUP_DECISIONS, THUMBNAILS
 from log import SCRIPT_DIR
+from tsv import TsvFile
 
 THE_TSV = SCRIPT_DIR.parent.parent / "site" / "static" / "annales-bia.tsv"
 SITE_IMG_DIR = SCRIPT_DIR.parent.parent / "site" / "static" / "img-sujets"
 
 CSV_DELIMITER = "\t"
 
-DEDUP_PREFIX = "image-dedup:"
+DEDUP_PREFIX = "image-dedup:"  # decisions used to be stored in DECISIONS
 DEDUP_PORT = 8001
 DEDUP_THRESHOLD = 10
 DEDUP_SSIM_THRESHOLD = 0.65
+DEDUP_PAGE_SIZE = 50
+DEDUP_REFRESH_SECONDS = 2  # page reload period while a rescan runs
+DEDUP_IMAGE_CACHE_BYTES = 64 * 1024 * 1024  # originals and PNG conversions served
+# the first scan collects pairs up to these looser thresholds, so tuning the
+# thresholds in the page only filters the edge list
+DEDUP_SWEEP_THRESHOLD = 16
+DEDUP_SWEEP_SSIM = 0.3
+
+# width of the cards in the review page, and twice that for hi-dpi screens
+THUMB_WIDTHS = (230, 460)
+THUMB_QUALITY = 85
+# image URLs carry the file version, so browsers may cache them forever
+IMMUTABLE = "public, max-age=31536000, immutable"
 
 Decision = dict[str, object]
 
@@ -67,112 +85,163 @@ def tsv_image_paths() -> list[Path]:
     return paths
 
 
-def dedup_cache_key(key: str) -> str:
-    return f"{DEDUP_PREFIX}{key}"
+def _migrate_legacy_decisions() -> None:
+    for cache_key in list(DECISIONS):
+        if not isinstance(cache_key, str) or not cache_key.startswith(DEDUP_PREFIX):
+            continue
+        value = DECISIONS.get(cache_key)
+        if isinstance(value, dict):
+            DEDUP_DECISIONS.set(cache_key[len(DEDUP_PREFIX) :], value)
+        del DECISIONS[cache_key]
+
+
+class DecisionStore:
+    """Decisions by group key, loaded once and written through to disk."""
+
+    def __init__(self) -> None:
+        self._decisions: dict[str, Decision] | None = None
+
+    @property
+    def decisions(self) -> dict[str, Decision]:
+        if self._decisions is None:
+            if len(DEDUP_DECISIONS) == 0:
+                _migrate_legacy_decisions()
+            self._decisions = {}
+            for key in DEDUP_DECISIONS:
+                value = DEDUP_DECISIONS.get(key)
+                if isinstance(value, dict):
+                    self._decisions[key] = value
+        return self._decisions
+
+    def get(self, key: str) -> Decision | None:
+        return self.decisions.get(key)
+
+    def set(self, key: str, decision: Decision) -> None:
+        DEDUP_DECISIONS.set(key, decision)
+        self.decisions[key] = decision
+
+    def clear(self) -> None:
+        DEDUP_DECISIONS.clear()
+        self._decisions = {}
+
+    def items(self) -> list[tuple[str, Decision]]:
+        return sorted(self.decisions.items())
+
+
+DECISION_STORE = DecisionStore()
 
 
 def get_decision(key: str) -> Decision | None:
-    value = DECISIONS.get(dedup_cache_key(key))
-    return value if isinstance(value, dict) else None
+    return DECISION_STORE.get(key)
 
 
 def set_decision(key: str, decision: Decision) -> None:
-    DECISIONS.set(dedup_cache_key(key), decision)
+    DECISION_STORE.set(key, decision)
 
 
 def clear_decisions() -> None:
-    for cache_key in list(DECISIONS):
-        if isinstance(cache_key, str) and cache_key.startswith(DEDUP_PREFIX):
-            del DECISIONS[cache_key]
+    DECISION_STORE.clear()
 
 
 def all_decisions() -> list[tuple[str, Decision]]:
-    res = []
-    for cache_key in list(DECISIONS):
-        if not isinstance(cache_key, str) or not cache_key.startswith(DEDUP_PREFIX):
-            continue
-        value = DECISIONS.get(cache_key)
-        if isinstance(value, dict):
-            res.append((cache_key[len(DEDUP_PREFIX) :], value))
-    return sorted(res)
+    return DECISION_STORE.items()
 
 
 def update_tsv_attachment_links(updates: dict[str, str]) -> int:
     if not updates:
         return 0
-    with open(THE_TSV, "r", newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=CSV_DELIMITER)
-        rows = list(reader)
-        fieldnames: list[str] = list(reader.fieldnames)  # type: ignore[assignment]
-    changed = 0
-    for row in rows:
-        link = row.get("attachment_link")
-        if link and link in updates:
-            row["attachment_link"] = updates[link]
-            changed += 1
-    with open(THE_TSV, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=CSV_DELIMITER)
-        writer.writeheader()
-        writer.writerows(rows)
-    return changed
-
-
-def apply_decisions(engine) -> tuple[int, int, int]:
-    tsv_updates: dict[str, str] = {}
-    applied = 0
+    tsv = TsvFile(THE_TSV)
+    changes = {
+        row["qid"]: {"attachment_link": updates[row["attachment_link"]]}
+        for row in tsv.rows()
+        if row.get("attachment_link") in updates
+    }
+    tsv.patch(changes)
+    return len(changes)
+
+
+def stem_rewrites(decisions: Sequence[tuple[str, Decision]]) -> dict[str, str]:
+    """Map each non-canonical attachment stem to the stem that replaces it.
+
+    Chains across groups (A -> B in one group, B -> C in another) are followed
+    so every old stem points straight at its final stem.
+    """
+    rewrites: dict[str, str] = {}
+    for group_key, value in decisions:
+        canonical = value.get("canonical")
+        if value["type"] != "canonical" or not canonical:
+            continue
+        names = group_key.split("|")
+        assert canonical in names, f"canonical {canonical!r} not in group {group_key!r}"
+        new_stem = Path(canonical).stem
+        for name in names:
+            old_stem = Path(name).stem
+            if old_stem != new_stem:
+                rewrites[old_stem] = new_stem
+    for old_stem in rewrites:
+        new_stem, seen = rewrites[old_stem], {old_stem}
+        while new_stem in rewrites and new_stem not in seen:
+            seen.add(new_stem)
+            new_stem = rewrites[new_stem]
+        rewrites[old_stem] = new_stem
+    return {old: new for old, new in rewrites.items() if old != new}
+
+
+def apply_decisions(
+    engine, attachment_map: dict[str, list[dict]] | None = None
+) -> tuple[int, int, int]:
+    """Apply pending decisions in one transaction.
+
+    Attachment links are rewritten with a single UPDATE keyed by the
+    stem-rewrite map; `attachment_map`, when given, is patched to match.
+    """
+    pending = [
+        (key, value) for key, value in all_decisions() if not value.get("applied")
+    ]
+    if not pending:
+        print("Applied 0 decisions")
+        return 0, 0, 0
+    rewrites = stem_rewrites(pending)
     db_rows = 0
     with Session(engine) as session:
-        for group_key, value in all_decisions():
-            if value.get("applied"):
-                continue
-            applied += 1
-            canonical = value.get("canonical")
-            decision_type = value["type"]
-            assert isinstance(canonical, str) or canonical is None
-            assert isinstance(decision_type, str)
-            if decision_type == "canonical" and canonical:
-                names = group_key.split("|")
-                assert canonical in names, (
-                    f"canonical {canonical!r} not in group {group_key!r}"
-                )
-                for name in names:
-                    if name == canonical:
-                        continue
-                    old_stem = Path(name).stem
-                    new_stem = Path(canonical).stem
-                    if old_stem != new_stem:
-                        tsv_updates[old_stem] = new_stem
-                        rows = session.exec(
-                            select(ConsolidatedQuestion).where(
-                                col(ConsolidatedQuestion.attachment_link) == old_stem
-                            )
-                        ).all()
-                        for row in rows:
-                            row.attachment_link = new_stem
-                        session.add_all(rows)
-                        db_rows += len(rows)
-            existing = session.get(ImageDedupDecision, group_key)
-            if existing is None:
-                session.add(
-                    ImageDedupDecision(
-                        pair_key=group_key,
-                        decision=decision_type,
-                        canonical=canonical,
-                    )
+        if rewrites:
+            link = col(ConsolidatedQuestion.attachment_link)
+            result = session.exec(
+                update(ConsolidatedQuestion)
+                .where(link.in_(rewrites))
+                .values(attachment_link=case(rewrites, value=link))
+                .execution_options(synchronize_session=False)
+            )
+            db_rows = result.rowcount
+        keys = [key for key, _ in pending]
+        existing = {
+            d.pair_key: d
+            for d in session.exec(
+                select(ImageDedupDecision).where(
+                    col(ImageDedupDecision.pair_key).in_(keys)
                 )
-            else:
-                existing.decision = decision_type
-                existing.canonical = canonical
-                session.add(existing)
-            value["applied"] = True
-            DECISIONS.set(dedup_cache_key(group_key), value)
+            )
+        }
+        for group_key, value in pending:
+            row = existing.get(group_key) or ImageDedupDecision(pair_key=group_key)
+            row.decision = value["type"]
+            row.canonical = value.get("canonical")
+            session.add(row)
         session.commit()
-    tsv_changed = update_tsv_attachment_links(tsv_updates)
+    for group_key, value in pending:
+        set_decision(group_key, {**value, "applied": True})
+    if attachment_map is not None:
+        rewrite_attachment_map(attachment_map, rewrites)
+    tsv_changed = update_tsv_attachment_links(rewrites)
     print(
-        f"Applied {applied} decisions: updated {db_rows} rows in DB, "
+        f"Applied {len(pending)} decisions: updated {db_rows} rows in DB, "
         f"{tsv_changed} rows in TSV"
     )
-    return applied, db_rows, tsv_changed
+    return len(pending), db_rows, tsv_changed
+
+
+def question_order(question: dict) -> tuple[int, int]:
+    return question["year"], question["no"]
 
 
 def build_attachment_map(engine) -> dict[str, list[dict]]:
@@ -191,10 +260,24 @@ def build_attachment_map(engine) -> dict[str, list[dict]]:
             }
         )
     for lst in res.values():
-        lst.sort(key=lambda r: (r["year"], r["no"]))
+        lst.sort(key=question_order)
     return res
 
 
+def rewrite_attachment_map(
+    attachment_map: dict[str, list[dict]], rewrites: dict[str, str]
+) -> None:
+    """Move the questions of rewritten stems under their new stem, in place."""
+    touched = set()
+    for old_stem, new_stem in rewrites.items():
+        moved = attachment_map.pop(old_stem, None)
+        if moved:
+            attachment_map.setdefault(new_stem, []).extend(moved)
+            touched.add(new_stem)
+    for stem in touched:
+        attachment_map[stem].sort(key=question_order)
+
+
 def questions_for_image(attachment_map: dict[str, list[dict]], name: str) -> list[dict]:
     return attachment_map.get(Path(name).stem, [])
 
@@ -211,12 +294,44 @@ def render_questions(questions: list[dict]) -> str:
     return "<ul>" + "".join(items) + "</ul>"
 
 
+def image_version(path: Path) -> str:
+    st = path.stat()
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def image_size(path: Path) -> tuple[int, int] | None:
+    """Pixel size of an image, cached until the file changes."""
+    key = ("size", str(path), image_version(path))
+    size = THUMBNAILS.get(key)
+    if size is None:
+        try:
+            with Image.open(path) as im:
+                size = ImageOps.exif_transpose(im).size
+        except Exception:
+            return None
+        THUMBNAILS.set(key, size)
+    return size
+
+
 def image_dims(path: Path) -> str:
-    try:
-        with Image.open(path) as im:
-            return f"{im.size[0]} &times; {im.size[1]} px"
-    except Exception:
-        return ""
+    size = image_size(path)
+    return f"{size[0]} &times; {size[1]} px" if size else ""
+
+
+def thumbnail(path: Path, width: int) -> bytes:
+    """JPEG of the image scaled down to `width`, cached until the file changes."""
+    key = ("thumb", str(path), image_version(path), width)
+    data = THUMBNAILS.get(key)
+    if data is None:
+        with Image.open(path) as image:
+            image.draft("RGB", (width, width))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            image.save(buf, format="JPEG", quality=THUMB_QUALITY)
+        data = buf.getvalue()
+        THUMBNAILS.set(key, data)
+    return data
 
 
 @dataclass
@@ -299,6 +414,10 @@ header{display:flex;justify-content:space-between;align-items:center;border-bott
 .badge.reject{background:#fee2e2;color:#991b1b;border-color:#fca5a5}
 .badge.exact{background:#dbeafe;color:#1e40af;border-color:#93c5fd}
 .actions{display:flex;gap:.5rem;margin-top:1rem}
+.field.check{flex-direction:row;align-items:center;gap:.35rem}
+.pages{display:flex;gap:.75rem;align-items:center;margin:0 0 1rem;font-size:.9rem}
+.muted{color:#9ca3af}
+.scanning{background:#fef3c7;border:1px solid #fcd34d;border-radius:6px;padding:.5rem .75rem}
 button{padding:.6rem .9rem;border-radius:6px;border:1px solid #d1d5db;cursor:pointer;font-size:.9rem}
 code{background:#f3f4f6;padding:.1rem .3rem;border-radius:4px;font-size:.8rem}
 """
@@ -323,9 +442,15 @@ def render_group_row(state: "ReviewState", group: DuplicateGroup) -> str:
     for name in group.names:
         questions = questions_for_image(state.attachment_map, name)
         checked = " checked" if decision and decision.get("canonical") == name else ""
+        q = f"{html.escape(name)}?v={image_version(state.name_to_path[name])}"
+        srcset = ", ".join(
+            f"/thumb/{width}/{q} {width // THUMB_WIDTHS[0]}x" for width in THUMB_WIDTHS
+        )
         items.append(
             "<div class='item'>"
-            f"<figure><img src='/img/{html.escape(name)}' alt='{html.escape(name)}'>"
+            f"<figure><a href='/img/{q}' target='_blank'>"
+            f"<img src='/thumb/{THUMB_WIDTHS[0]}/{q}' srcset='{srcset}' "
+            f"loading='lazy' alt='{html.escape(name)}'></a>"
             f"<figcaption>{html.escape(name)}<br>"
             f"{image_dims(state.name_to_path[name])}</figcaption></figure>"
             f"<label><input type='radio' name='dec:{html.escape(group.key)}' "
@@ -351,37 +476,148 @@ def render_group_row(state: "ReviewState", group: DuplicateGroup) -> str:
     )
 
 
-def render_groups_page(state: "ReviewState") -> str:
-    decided = sum(1 for g in state.groups if get_decision(g.key) is not None)
-    rows = [render_group_row(state, g) for g in state.groups]
-    return f"""<!DOCTYPE html>
+@dataclass
+class GroupView:
+    """Thresholds, filters and page requested by one client of the review page.
+
+    Carried by the URL and by hidden fields of the page's forms, never stored
+    in the shared ReviewState.
+    """
+
+    threshold: int = DEDUP_THRESHOLD
+    ssim: float = DEDUP_SSIM_THRESHOLD
+    pending: bool = False  # only groups without a decision
+    exact: bool = False  # only groups with byte-identical members
+    min_size: int = 2
+    page: int = 1
+    per_page: int = DEDUP_PAGE_SIZE
+
+    def matches(self, group: DuplicateGroup) -> bool:
+        if self.pending and get_decision(group.key) is not None:
+            return False
+        if self.exact and not group.exact:
+            return False
+        return len(group.names) >= self.min_size
+
+    def params(self, page: int | None = None) -> dict[str, object]:
+        params: dict[str, object] = {
+            "threshold": self.threshold,
+            "ssim": self.ssim,
+            "min_size": self.min_size,
+            "per_page": self.per_page,
+            "page": self.page if page is None else page,
+        }
+        if self.pending:
+            params["pending"] = "on"
+        if self.exact:
+            params["exact"] = "on"
+        return params
+
+    def query(self, page: int | None = None) -> str:
+        return urlencode(self.params(page))
+
+    def hidden_fields(self) -> str:
+        return "".join(
+            f"<input type='hidden' name='{name}' value='{html.escape(str(value))}'>"
+            for name, value in self.params().items()
+        )
+
+    @classmethod
+    def from_form(cls, form: Mapping[str, object]) -> GroupView:
+        def number(name: str, convert: type, default, minimum=None):
+            try:
+                value = convert(form[name])
+            except (KeyError, TypeError, ValueError):
+                return default
+            return value if minimum is None else max(minimum, value)
+
+        return cls(
+            threshold=number("threshold", int, DEDUP_THRESHOLD),
+            ssim=number("ssim", float, DEDUP_SSIM_THRESHOLD),
+            pending=form.get("pending") == "on",
+            exact=form.get("exact") == "on",
+            min_size=number("min_size", int, 2, 2),
+            page=number("page", int, 1, 1),
+            per_page=number("per_page", int, DEDUP_PAGE_SIZE, 1),
+        )
+
+
+def render_pages_nav(view: GroupView, page: int, pages: int) -> str:
+    def link(label: str, target: int) -> str:
+        if target < 1 or target > pages or target == page:
+            return f"<span class='muted'>{label}</span>"
+        return f"<a href='{html.escape(page_url(view, target))}'>{label}</a>"
+
+    return (
+        "<nav class='pages'>"
+        f"{link('&laquo; Previous', page - 1)}"
+        f"<span>Page {page} of {pages}</span>"
+        f"{link('Next &raquo;', page + 1)}"
+        "</nav>"
+    )
+
+
+def render_scan_status(scan: ScanJob | None) -> str:
+    if scan is None:
+        return ""
+    threshold, ssim = scan.params
+    progress = f" ({scan.done}/{scan.total})" if scan.total else ""
+    return (
+        f"<p class='scanning'>Scanning for hamming &le; {threshold}, "
+        f"ssim &ge; {ssim}: {html.escape(scan.phase)}{progress}&hellip; "
+        "Showing the previous results until it is done.</p>"
+    )
+
+
+def iter_groups_page(state: "ReviewState", view: GroupView) -> Iterator[str]:
+    """Yield the review page in pieces: the header, then one group at a time."""
+    # a background rescan may replace the groups while the page streams
+    all_groups, scan = state.groups, state.scan
+    groups = [g for g in all_groups if view.matches(g)]
+    pages = max(1, -(-len(groups) // view.per_page))
+    page = min(view.page, pages)
+    shown = groups[(page - 1) * view.per_page : page * view.per_page]
+    decided = sum(1 for g in all_groups if get_decision(g.key) is not None)
+    nav = render_pages_nav(view, page, pages)
+    yield f"""<!DOCTYPE html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
+{f'<meta http-equiv="refresh" content="{DEDUP_REFRESH_SECONDS}">' if scan else ""}
 <title>Review duplicate image groups</title>
 <style>{DEDUP_CSS}</style>
 </head>
 <body>
 <header>
   <div><strong>Duplicate image review</strong></div>
-  <form method="post" action="/reset"><button type="submit">Reset all decisions</button></form>
+  <form method="post" action="/reset">{view.hidden_fields()}<button type="submit">Reset all decisions</button></form>
 </header>
 <form method="get" action="/">
   <div class="toolbar">
-    <div class="field"><label>Hamming threshold (0&ndash;64, lower = stricter)</label><input type="number" name="threshold" min="0" max="64" value="{state.threshold}"></div>
-    <div class="field"><label>SSIM threshold (0&ndash;1, higher = stricter)</label><input type="number" name="ssim" min="0" max="1" step="0.05" value="{state.ssim_threshold}"></div>
+    <div class="field"><label>Hamming threshold (0&ndash;64, lower = stricter)</label><input type="number" name="threshold" min="0" max="64" value="{view.threshold}"></div>
+    <div class="field"><label>SSIM threshold (0&ndash;1, higher = stricter)</label><input type="number" name="ssim" min="0" max="1" step="0.05" value="{view.ssim}"></div>
+    <div class="field"><label>Min group size</label><input type="number" name="min_size" min="2" value="{view.min_size}"></div>
+    <div class="field"><label>Groups per page</label><input type="number" name="per_page" min="1" value="{view.per_page}"></div>
+    <div class="field check"><input type="checkbox" id="pending" name="pending"{" checked" if view.pending else ""}><label for="pending">Pending only</label></div>
+    <div class="field check"><input type="checkbox" id="exact" name="exact"{" checked" if view.exact else ""}><label for="exact">Byte-identical only</label></div>
     <div class="field"><label>&nbsp;</label><button type="submit">Rescan</button></div>
   </div>
 </form>
-<p class="summary">{len(state.groups)} groups &mdash; {decided} decided, {len(state.groups) - decided} pending (threshold: hamming &le; {state.threshold}, ssim &ge; {state.ssim_threshold}).</p>
+{render_scan_status(scan)}
+<p class="summary">{len(all_groups)} groups &mdash; {decided} decided, {len(all_groups) - decided} pending (threshold: hamming &le; {state.threshold}, ssim &ge; {state.ssim_threshold}); {len(groups)} shown by the filters.</p>
 {f'<p class="applied">{html.escape(state.last_apply)}</p>' if state.last_apply else ""}
+{nav}
 <form method="post" action="/decision">
-  {"".join(rows)}
-  <div class="actions">
+{view.hidden_fields()}
+"""
+    for group in shown:
+        yield render_group_row(state, group)
+    yield f"""  <div class="actions">
     <button type="submit" name="save" value="1">Save all decisions</button>
     <button type="submit" name="apply" value="1">Apply decisions to database + TSV</button>
   </div>
 </form>
+{nav}
 </body>
 </html>"""
 
@@ -394,16 +630,108 @@ def convert_to_png(path: Path) -> bytes:
         return buf.getvalue()
 
 
+def image_payload(path: Path) -> tuple[bytes, str]:
+    """Bytes and media type served for an image; browsers get PNG for non-JPEG/PNG."""
+    suffix = path.suffix.lower()
+    if suffix in {".png", ".jpg", ".jpeg"}:
+        return path.read_bytes(), f"image/{'png' if suffix == '.png' else 'jpeg'}"
+    return convert_to_png(path), "image/png"
+
+
+class PayloadCache:
+    """Byte-budgeted LRU of served image payloads, dropped when the file changes."""
+
+    budget: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # path -> (file version, bytes, media type), least recently used first
+        self._entries: OrderedDict[str, tuple[str, bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> tuple[bytes, str]:
+        key, version = str(path), image_version(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        data, media_type = image_payload(path)
+        with self._lock:
+            self._discard(key)
+            if len(data) <= self.budget:
+                self._entries[key] = (version, data, media_type)
+                self.size += len(data)
+            while self.size > self.budget:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return data, media_type
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+@dataclass
+class ScanJob:
+    """A rescan running in the background, with its progress."""
+
+    params: tuple[int, float]  # (threshold, ssim_threshold)
+    phase: str = "starting"
+    done: int = 0
+    total: int = 0
+
+    def update(self, phase: str, done: int, total: int) -> None:
+        self.phase, self.done, self.total = phase, done, total
+
+
 class ReviewState:
+    """Groups shown by the review app.
+
+    Rescans that need new image features or pairs run in a background
+    thread, one at a time; the page keeps showing the previous groups
+    meanwhile. Requests for the parameters being scanned join that scan, and
+    other parameters wait for it (the latest request wins).
+    """
+
     engine: object
     attachment_map: dict[str, list[dict]]
     name_to_path: dict[str, Path]
-    converted: dict[str, bytes]
+    images: PayloadCache
     threshold: int
     ssim_threshold: float
     groups: list[DuplicateGroup]
+    edges: EdgeList | None
     last_scan: tuple[int, float] | None
     last_apply: str | None
+    jobs: int
+    scan: ScanJob | None  # the background rescan, if one is running
+    queued: tuple[int, float] | None  # parameters requested during the scan
 
     def __init__(
         self,
@@ -411,78 +739,169 @@ class ReviewState:
         attachment_map: dict[str, list[dict]],
         threshold: int,
         ssim_threshold: float,
+        jobs: int = 1,
     ) -> None:
         self.engine = engine
         self.attachment_map = attachment_map
         self.name_to_path = {}
-        self.converted = {}
+        self.images = PayloadCache(DEDUP_IMAGE_CACHE_BYTES)
         self.threshold = threshold
         self.ssim_threshold = ssim_threshold
         self.groups = []
+        self.edges = None
         self.last_scan = None
         self.last_apply = None
+        self.jobs = jobs
+        self.scan = None
+        self.queued = None
+        self._lock = threading.Lock()
 
     def rescan(
         self, threshold: int, ssim_threshold: float, verbose: bool = False
     ) -> None:
+        """Rescan in the calling thread."""
         if (threshold, ssim_threshold) == self.last_scan:
             return
-        self.threshold = threshold
-        self.ssim_threshold = ssim_threshold
+        edges = self._scan_edges(threshold, ssim_threshold, verbose)
+        with self._lock:
+            self._select(edges, threshold, ssim_threshold, verbose)
+
+    def request_rescan(self, threshold: int, ssim_threshold: float) -> None:
+        """Show groups for these thresholds, scanning in the background if needed."""
+        params = (threshold, ssim_threshold)
+        with self._lock:
+            if self.scan is not None:
+                if params != self.scan.params:
+                    self.queued = params
+                return
+            if params == self.last_scan:
+                return
+            if self.edges is not None and self.edges.covers(*params):
+                self._select(self.edges, *params)
+                return
+            self.scan = ScanJob(params)
+        threading.Thread(target=self._run_scan, args=(self.scan,), daemon=True).start()
+
+    def _run_scan(self, job: ScanJob) -> None:
+        try:
+            edges = self._scan_edges(*job.params, progress=job.update)
+        except Exception as e:
+            print(f"Rescan failed: {e!r}")
+            edges = None
+        with self._lock:
+            if edges is not None:
+                self._select(edges, *job.params)
+            self.scan = None
+            queued, self.queued = self.queued, None
+        if queued is not None:
+            self.request_rescan(*queued)
+
+    def _scan_edges(
+        self,
+        threshold: int,
+        ssim_threshold: float,
+        verbose: bool = False,
+        progress: Progress | None = None,
+    ) -> EdgeList:
+        edges = self.edges
+        if edges is not None and edges.covers(threshold, ssim_threshold):
+            return edges
+        # only ever loosen the scanned range
+        max_threshold = max(threshold, DEDUP_SWEEP_THRESHOLD)
+        min_ssim = min(ssim_threshold, DEDUP_SWEEP_SSIM)
+        if edges is not None:
+            max_threshold = max(max_threshold, edges.max_threshold)
+            min_ssim = min(min_ssim, edges.min_ssim)
         print(
-            f"Scanning images for duplicates (hamming<={threshold}, "
-            f"ssim>={ssim_threshold})..."
+            f"Scanning images for duplicates (hamming<={max_threshold}, "
+            f"ssim>={min_ssim})..."
         )
-        paths = tsv_image_paths()
-        exact, pairs = find_duplicate_groups_from_paths(
-            paths, threshold, ssim_threshold, verbose=verbose
+        edges = scan_edges(
+            tsv_image_paths(),
+            max_threshold,
+            min_ssim,
+            verbose=verbose,
+            jobs=self.jobs,
+            progress=progress,
         )
-        if exact:
+        if edges.exact:
             print("=== Exact duplicates (identical bytes) ===")
-            for names in exact.values():
+            for names in edges.exact.values():
                 print("  " + " == ".join(names))
-        name_to_path = {path.name: path for path in paths}
-        self.groups = build_duplicate_groups(exact, pairs)
-        self.name_to_path = {
-            name: name_to_path[name] for group in self.groups for name in group.names
-        }
+        return edges
+
+    def _select(
+        self,
+        edges: EdgeList,
+        threshold: int,
+        ssim_threshold: float,
+        verbose: bool = False,
+    ) -> None:
+        pairs = edges.select(threshold, ssim_threshold)
+        if verbose:
+            print_pairs(pairs)
+        # every scanned image, so that pages rendered from older groups
+        # still find theirs
+        self.name_to_path = {path.name: path for path in edges.paths}
+        self.groups = build_duplicate_groups(edges.exact, pairs)
+        self.edges = edges
+        self.threshold = threshold
+        self.ssim_threshold = ssim_threshold
         self.last_scan = (threshold, ssim_threshold)
         self.last_apply = None
         pending = sum(1 for g in self.groups if get_decision(g.key) is None)
         print(f"{len(self.groups)} duplicate groups found, {pending} pending review")
 
 
-def back_url(state: "ReviewState") -> str:
-    return f"/?threshold={state.threshold}&ssim={state.ssim_threshold}"
+def page_url(view: GroupView, page: int | None = None) -> str:
+    return f"/?{view.query(page)}"
 
 
 def create_dedup_app(state: ReviewState) -> FastAPI:
     app = FastAPI(title="Duplicate image review")
 
-    @app.get("/", response_class=HTMLResponse)
+    @app.get("/")
     def index(
         threshold: int = Query(default=DEDUP_THRESHOLD),
         ssim: float = Query(default=DEDUP_SSIM_THRESHOLD),
-    ) -> str:
-        state.rescan(threshold, ssim)
-        return render_groups_page(state)
+        pending: bool = Query(default=False),
+        exact: bool = Query(default=False),
+        min_size: int = Query(default=2, ge=2),
+        page: int = Query(default=1, ge=1),
+        per_page: int = Query(default=DEDUP_PAGE_SIZE, ge=1),
+    ) -> StreamingResponse:
+        state.request_rescan(threshold, ssim)
+        view = GroupView(threshold, ssim, pending, exact, min_size, page, per_page)
+        return StreamingResponse(iter_groups_page(state, view), media_type="text/html")
 
     @app.get("/img/{name}")
     def serve_image(name: str) -> Response:
         path = state.name_to_path.get(name)
         if path is None or not path.is_file():
             return Response("Not found", status_code=404, media_type="text/plain")
-        suffix = path.suffix.lower()
-        if suffix in {".png", ".jpg", ".jpeg"}:
-            return Response(
-                path.read_bytes(),
-                media_type=f"image/{'png' if suffix == '.png' else 'jpeg'}",
-            )
-        converted = state.converted.get(name)
-        if converted is None:
-            converted = convert_to_png(path)
-            state.converted[name] = converted
-        return Response(converted, media_type="image/png")
+        data, media_type = state.images.get(path)
+        return Response(
+            data, media_type=media_type, headers={"Cache-Control": IMMUTABLE}
+        )
+
+    @app.get("/stats")
+    def stats() -> dict[str, object]:
+        scan = state.scan
+        return {
+            "images": state.images.stats(),
+            "scan": asdict(scan) if scan is not None else None,
+        }
+
+    @app.get("/thumb/{width}/{name}")
+    def serve_thumbnail(width: int, name: str) -> Response:
+        path = state.name_to_path.get(name)
+        if width not in THUMB_WIDTHS or path is None or not path.is_file():
+            return Response("Not found", status_code=404, media_type="text/plain")
+        return Response(
+            thumbnail(path, width),
+            media_type="image/jpeg",
+            headers={"Cache-Control": IMMUTABLE},
+        )
 
     @app.post("/decision")
     async def decision(request: Request) -> RedirectResponse:
@@ -500,23 +919,25 @@ def create_dedup_app(state: ReviewState) -> FastAPI:
                 set_decision(key, {"type": "reject"})
         if form.get("apply"):
             _apply(state)
-        return RedirectResponse(back_url(state), status_code=303)
+        return RedirectResponse(page_url(GroupView.from_form(form)), status_code=303)
 
     @app.post("/reset")
-    def reset() -> RedirectResponse:
+    async def reset(request: Request) -> RedirectResponse:
+        form = await request.form()
         clear_decisions()
-        return RedirectResponse(back_url(state), status_code=303)
+        return RedirectResponse(page_url(GroupView.from_form(form)), status_code=303)
 
     @app.post("/apply")
-    def apply() -> RedirectResponse:
+    async def apply(request: Request) -> RedirectResponse:
+        form = await request.form()
         _apply(state)
-        return RedirectResponse(back_url(state), status_code=303)
+        return RedirectResponse(page_url(GroupView.from_form(form)), status_code=303)
 
     return app
 
 
 def _apply(state: "ReviewState") -> None:
-    applied, db_rows, tsv_changed = apply_decisions(state.engine)
+    applied, db_rows, tsv_changed = apply_decisions(state.engine, state.attachment_map)
     state.last_apply = (
         f"Applied {applied} decision(s): {db_rows} DB row(s) and "
         f"{tsv_changed} TSV row(s) updated."
@@ -530,6 +951,7 @@ def review_image_duplicates(engine, args) -> None:
         attachment_map=attachment_map,
         threshold=args.threshold,
         ssim_threshold=args.ssim_threshold,
+        jobs=args.jobs,
     )
     state.rescan(args.threshold, args.ssim_threshold, verbose=True)
     app = create_dedup_app(state)
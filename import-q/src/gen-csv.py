@@ -26,6 +26,9 @@ from models import (
     AnnaleToAfMapping,
     gen_unique_id,
     ConsolidatedQuestion,
+    QuestionAlignment,
+    backfill_content_clean,
+    pair_fingerprint,
 )
 from dedup import (
     DEDUP_PORT,
@@ -34,6 +37,8 @@ from dedup import (
     review_image_duplicates,
 )
 from log import SCRIPT_DIR, log
+from tsv import TsvFile
+from utils import add_jobs_argument
 
 #############
 # Constants #
@@ -54,7 +59,7 @@ THE_CSV = THE_TSV
 def gen_consolidated(engine):
     with Session(engine) as session:
         statement = (
-            select(AnnaleQuestion, AfQuestion)
+            select(AnnaleQuestion, AfQuestion, AnnaleToAfMapping)
             .outerjoin(
                 AnnaleToAfMapping,
                 col(AnnaleQuestion.question_id)
@@ -70,13 +75,14 @@ def gen_consolidated(engine):
             )
         )
         results = sorted(
-            session.exec(statement).all(), key=lambda pair: annale_label_to_ord(pair[0])
+            session.exec(statement).all(), key=lambda row: annale_label_to_ord(row[0])
         )
         print("Total consolidated questions to generate:", len(results))
     year = None
     i = 0
+    recomputed = 0
     with Session(engine) as session:
-        for annale, af in results:
+        for annale, af, mapping in results:
             if year is None:
                 year = annale.year
             if year != annale.year:
@@ -85,7 +91,21 @@ def gen_consolidated(engine):
 
             fixed = None
             if af is not None:
-                leven = Levenshtein.distance(af.clean_content(), annale.clean_content())
+                # distance stored at link time, unless either content changed since
+                fingerprint = pair_fingerprint(af, annale)
+                if (
+                    mapping.leven_dist is not None
+                    and mapping.content_fingerprint == fingerprint
+                ):
+                    leven = mapping.leven_dist
+                else:
+                    leven = Levenshtein.distance(
+                        af.clean_content(), annale.clean_content()
+                    )
+                    mapping.leven_dist = leven
+                    mapping.content_fingerprint = fingerprint
+                    session.add(mapping)
+                    recomputed += 1
                 if leven >= 5 or len(annale.content) >= (len(af.content) + 5):
                     fixed = af.content
 
@@ -112,6 +132,7 @@ def gen_consolidated(engine):
             session.add(c)
             i += 1
         session.commit()
+    print("Levenshtein distances recomputed:", recomputed)
 
 
 def gen_consolidated_pdf(engine):
@@ -120,6 +141,19 @@ def gen_consolidated_pdf(engine):
         pdf_questions = session.exec(statement).all()
         results = sorted(pdf_questions, key=annale_label_to_ord)
         print("Total PDF questions retrieved:", len(results))
+        # matched to an annale question by `compare.py run align_all`, so
+        # already consolidated from it when that question is of the same
+        # year (the alignment itself ignores years)
+        aligned = set(
+            session.exec(
+                select(QuestionAlignment.pdf_question_id, AnnaleQuestion.year)
+                .join(
+                    AnnaleQuestion,
+                    AnnaleQuestion.question_id == QuestionAlignment.annale_question_id,
+                )
+                .where(col(QuestionAlignment.pdf_question_id).is_not(None))
+            ).all()
+        )
 
     generated_questions = []
     current_year = None
@@ -147,7 +181,7 @@ def gen_consolidated_pdf(engine):
             attachment_link=None,
             mixed_choices=None,
         )
-        generated_questions.append(c)
+        generated_questions.append((pdf, c))
         i += 1
 
     with Session(engine) as session:
@@ -155,7 +189,11 @@ def gen_consolidated_pdf(engine):
         existing_year_no = {(cq.year, cq.no) for cq in existing}
 
         added_count = 0
-        for c in generated_questions:
+        aligned_count = 0
+        for pdf, c in generated_questions:
+            if (pdf.question_id, pdf.year) in aligned:
+                aligned_count += 1
+                continue
             key = (c.year, c.no)
             if key in existing_year_no:
                 continue
@@ -165,7 +203,10 @@ def gen_consolidated_pdf(engine):
             added_count += 1
 
         session.commit()
-        print(f"Added {added_count} new consolidated questions from PDF.")
+        print(
+            f"Added {added_count} new consolidated questions from PDF "
+            f"({aligned_count} skipped as aligned to an annale question)."
+        )
 
 
 def annale_label_to_ord(annale) -> Tuple[int, int, int]:
@@ -200,44 +241,36 @@ def from_label_subject_and_no(label: str) -> Tuple[int, int]:
     return (subject_no, question_no)
 
 
-def open_csv_with_fieldnames() -> Tuple[list[str], Iterable[any]]:
-    with open(THE_CSV, "r", newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=CSV_DELIMITER)
-        rows = list(reader)
-
-    old_fields: list[str] = list(reader.fieldnames)  # type: ignore
-    return old_fields, rows
-
+def open_csv_with_fieldnames() -> Tuple[list[str], TsvFile]:
+    tsv = TsvFile(THE_CSV)
+    return list(tsv.fieldnames), tsv
 
-def cap_bool(v):
-    # Only convert actual booleans (not truthy values like 1, "yes", etc.)
-    if isinstance(v, bool):
-        return "TRUE" if v else "FALSE"
-    return v
 
-
-def write_csv(fieldnames, rows) -> None:
-    with open(THE_CSV, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=CSV_DELIMITER)
-        writer.writeheader()
-        for row in rows:
-            writer.writerows({k: cap_bool(v) for k, v in row.items()} for row in rows)
+def write_csv(tsv: TsvFile, fieldnames, rows: Iterable[dict]) -> None:
+    # rows are streamed one by one, and must map one to one to the TSV rows;
+    # the TSV writer writes actual booleans as TRUE/FALSE
+    changed = tsv.save(rows, fieldnames, expected_rows=len(tsv))
+    print(f"{THE_CSV.name} {'updated' if changed else 'unchanged'}")
 
 
 def add_subject_to_csv(_):
-    old_fields, rows = open_csv_with_fieldnames()
+    old_fields, tsv = open_csv_with_fieldnames()
     assert old_fields
     assert "subject" not in old_fields, "subject column already exists"
     new_fields = deepcopy(old_fields)
     new_fields.remove("label")
     new_fields.insert(2, "subject")
     new_fields.insert(3, "no_subject")
-    for row in rows:
-        subject_no, question_no = from_label_subject_and_no(row["label"])
-        row["subject"] = subject_no
-        row["no_subject"] = question_no
-        del row["label"]
-    write_csv(new_fields, rows)
+
+    def rows():
+        for row in tsv.rows():
+            subject_no, question_no = from_label_subject_and_no(row["label"])
+            row["subject"] = subject_no
+            row["no_subject"] = question_no
+            del row["label"]
+            yield row
+
+    write_csv(tsv, new_fields, rows())
 
 
 CHAPTERS = {
@@ -260,15 +293,20 @@ CHAPTERS = {
 
 
 def change_chapters_to_number_csv(_):
-    old_fields, rows = open_csv_with_fieldnames()
+    old_fields, tsv = open_csv_with_fieldnames()
     new_fields = deepcopy(old_fields)
-    for row in rows:
-        if row["chapter"] != "":
-            if row["chapter"] in ["5.", "6."]:  # We do not split those into chapters
-                row["chapter"] = None
-            else:
-                row["chapter"] = CHAPTERS[row["chapter"]]
-    write_csv(new_fields, rows)
+
+    def rows():
+        for row in tsv.rows():
+            if row["chapter"] != "":
+                # We do not split those into chapters
+                if row["chapter"] in ["5.", "6."]:
+                    row["chapter"] = None
+                else:
+                    row["chapter"] = CHAPTERS[row["chapter"]]
+            yield row
+
+    write_csv(tsv, new_fields, rows())
 
 
 def export_csv(engine):
@@ -300,22 +338,18 @@ def export_csv(engine):
     assert sorted(fieldnames) == sorted(
         keys
     ), f"Fieldnames do not match dict keys:\nFieldnames: {fieldnames}\nDict keys: {keys}"
-    with open(THE_CSV, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=CSV_DELIMITER)
-        writer.writeheader()
-        for d in dicts:
-            del d["created_at"]
-            for k, v in d.items():
-                if isinstance(v, str):
-                    assert (
-                        CSV_DELIMITER not in v
-                    ), f"Value contains delimiter {CSV_DELIMITER}: {v} for {d}"
-                # We want to write actual booleans as TRUE/FALSE, not 1/0 or yes/no
-                if isinstance(v, bool):
-                    d[k] = "TRUE" if v else "FALSE"
-            writer.writerow(d)
-
-    print("Exported consolidated_questions.csv")
+    for d in dicts:
+        del d["created_at"]
+        for k, v in d.items():
+            if isinstance(v, str):
+                assert (
+                    CSV_DELIMITER not in v
+                ), f"Value contains delimiter {CSV_DELIMITER}: {v} for {d}"
+    # booleans are written as TRUE/FALSE by the TSV writer
+    if TsvFile(THE_CSV).save(dicts, fieldnames):
+        print("Exported consolidated_questions.csv")
+    else:
+        print("consolidated_questions.csv unchanged")
 
 
 def import_tsv(engine):
@@ -410,6 +444,7 @@ def main() -> None:
         "gen+export": gen_and_export,
         "add_subject_to_csv": add_subject_to_csv,
         "change_chapters_to_number_csv": change_chapters_to_number_csv,
+        "backfill-content-clean": backfill_content_clean,
     }
     run_subparser = subparsers.add_parser("run", help="Run a command")
     run_subparser.add_argument(
@@ -437,6 +472,7 @@ def main() -> None:
         default=DEDUP_SSIM_THRESHOLD,
         help=f"Min SSIM score (default: {DEDUP_SSIM_THRESHOLD})",
     )
+    add_jobs_argument(dedup_parser, "to decode and hash images")
     dedup_parser.add_argument(
         "--skip-import",
         action="store_true",
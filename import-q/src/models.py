@@ -7,6 +7,8 @@
 from __future__ import annotations
 
 
+import hashlib
+
 import sqlalchemy
 import sqlmodel
 
@@ -23,13 +25,24 @@ class QuestionId(SQLModel, table=True):
     checked_at: Optional[datetime] = None  # When the question was populated
 
 
+NO_SPECIAL = str.maketrans("", "", "'‘’«»“”„")
+
+
 def cleaned_str(s: str) -> str:
     """Return the string with normalized whitespace."""
     no_multi_space_lowered = " ".join(s.split()).lower()
-    no_special = no_multi_space_lowered.translate(str.maketrans("", "", "'‘’«»“”„"))
+    no_special = no_multi_space_lowered.translate(NO_SPECIAL)
     return no_special
 
 
+def pair_fingerprint(af: AfQuestion, annale: AnnaleQuestion) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(af.clean_content().encode("utf-8"))
+    h.update(b"\0")
+    h.update(annale.clean_content().encode("utf-8"))
+    return h.hexdigest()
+
+
 # should be plenty of space for a ~1k question
 def gen_unique_id() -> str:
     import secrets
@@ -44,6 +57,26 @@ class AnnaleToAfMapping(SQLModel, table=True):
     annale_question_id: str = Field(primary_key=True)
     af_question_id: str = Field(index=True)
     is_same: Optional[bool] = None  # None = unchecked, True = same, False = different
+    # distance between the cleaned contents when linked, valid as long as
+    # content_fingerprint matches them (see pair_fingerprint)
+    leven_dist: Optional[int] = None
+    content_fingerprint: Optional[str] = Field(default=None, max_length=32)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class QuestionAlignment(SQLModel, table=True):
+    """One annale question with its AF and PDF counterparts (compare.py align_all)."""
+
+    annale_question_id: str = Field(primary_key=True)
+    af_question_id: Optional[str] = Field(default=None, index=True)
+    af_leven_dist: Optional[int] = None
+    pdf_question_id: Optional[str] = Field(default=None, index=True)
+    pdf_leven_dist: Optional[int] = None
+    annale_answer: int = Field(nullable=False)
+    af_answer: Optional[int] = None
+    pdf_answer: Optional[int] = None
+    # None when neither AF nor PDF answer is known
+    answers_agree: Optional[bool] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
@@ -51,6 +84,8 @@ class AfQuestion(SQLModel, table=True):
     __tablename__ = "question"  # type: ignore[assignment]
     question_id: str = Field(primary_key=True)  # Explicitly mark as primary key
     content: str = Field(max_length=1024)  # Optional description
+    # cleaned_str(content), set on insert/update, see _set_content_clean
+    content_clean: Optional[str] = Field(default=None, max_length=1024, index=True)
     choice_a: str = Field(min_length=1, nullable=False)
     choice_b: str = Field(min_length=1, nullable=False)
     choice_c: str = Field(min_length=1, nullable=False)
@@ -64,6 +99,8 @@ class AfQuestion(SQLModel, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     def clean_content(self) -> str:
+        if self.content_clean is not None:
+            return self.content_clean
         return cleaned_str(self.content)
 
     def merge_chapter(self, other: AfQuestion) -> None:
@@ -104,6 +141,8 @@ class AnnaleQuestion(SQLModel, table=True):
     year: int = Field()
     question_number: str = Field()
     content: str = Field(max_length=1024)  # Optional description
+    # cleaned_str(content), set on insert/update, see _set_content_clean
+    content_clean: Optional[str] = Field(default=None, max_length=1024, index=True)
     choice_a: str = Field(min_length=1, nullable=False)
     choice_b: str = Field(min_length=1, nullable=False)
     choice_c: str = Field(min_length=1, nullable=False)
@@ -114,6 +153,8 @@ class AnnaleQuestion(SQLModel, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     def clean_content(self) -> str:
+        if self.content_clean is not None:
+            return self.content_clean
         return cleaned_str(self.content)
 
 
@@ -122,6 +163,8 @@ class PdfQuestion(SQLModel, table=True):
     year: int = Field()
     question_number: str = Field()
     content: str = Field(max_length=1024)  # Optional description
+    # cleaned_str(content), set on insert/update, see _set_content_clean
+    content_clean: Optional[str] = Field(default=None, max_length=1024, index=True)
     choice_a: str = Field(min_length=1, nullable=False)
     choice_b: str = Field(min_length=1, nullable=False)
     choice_c: str = Field(min_length=1, nullable=False)
@@ -136,9 +179,48 @@ class PdfQuestion(SQLModel, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     def clean_content(self) -> str:
+        if self.content_clean is not None:
+            return self.content_clean
         return cleaned_str(self.content)
 
 
+CLEANED_MODELS: list[type[AfQuestion | AnnaleQuestion | PdfQuestion]] = [
+    AfQuestion,
+    AnnaleQuestion,
+    PdfQuestion,
+]
+
+
+def _set_content_clean(mapper, connection, target) -> None:
+    target.content_clean = cleaned_str(target.content)
+
+
+def _clear_content_clean(target, value, oldvalue, initiator) -> None:
+    # clean_content() must not return the cleaned old content before the flush
+    target.content_clean = None
+
+
+for _model in CLEANED_MODELS:
+    sqlalchemy.event.listen(_model, "before_insert", _set_content_clean)
+    sqlalchemy.event.listen(_model, "before_update", _set_content_clean)
+    sqlalchemy.event.listen(_model.content, "set", _clear_content_clean)
+
+
+def backfill_content_clean(engine) -> None:
+    """Fill content_clean of the rows written before the column existed."""
+    with sqlmodel.Session(engine) as session:
+        for model in CLEANED_MODELS:
+            updated = 0
+            for q in session.exec(sqlmodel.select(model)).all():
+                cleaned = cleaned_str(q.content)
+                if q.content_clean != cleaned:
+                    q.content_clean = cleaned
+                    session.add(q)
+                    updated += 1
+            log.info(f"Backfilled content_clean of {updated} {model.__name__} rows")
+        session.commit()
+
+
 def _ensure_column(engine, table: str, column: str, ddl_type: str) -> None:
     inspector = sqlalchemy.inspect(engine)
     if table not in inspector.get_table_names():
@@ -151,10 +233,25 @@ def _ensure_column(engine, table: str, column: str, ddl_type: str) -> None:
         )
 
 
+def _ensure_index(engine, table: str, column: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"
+            )
+        )
+
+
 def create_engine():
     engine = sqlmodel.create_engine(f"sqlite:///{SCRIPT_DIR.parent}/questions.db")
     SQLModel.metadata.create_all(engine)
     _ensure_column(engine, "pdfquestion", "chapter", "INTEGER")
+    _ensure_column(engine, "annaletoafmapping", "leven_dist", "INTEGER")
+    _ensure_column(engine, "annaletoafmapping", "content_fingerprint", "VARCHAR(32)")
+    for model in CLEANED_MODELS:
+        table = model.__tablename__
+        _ensure_column(engine, table, "content_clean", "VARCHAR(1024)")
+        _ensure_index(engine, table, "content_clean")
     if engine.url.database:
         log.info(f"Connected to database at {engine.url.database}")
     return engine
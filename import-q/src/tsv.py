@@ -0,0 +1,213 @@
+# coding: utf-8
+# Licence: GNU AGPLv3
+
+"""Row-level rewrites of the annales TSV.
+
+The file is kept in memory as its bytes only, along with the byte offset
+where each row starts and the row of each qid; rows are parsed on demand.
+Saving copies the unchanged prefix verbatim and encodes only from the first
+changed row; the result goes to a temporary file renamed over the target,
+and nothing is written when the content is unchanged, so watchers and the
+site build don't see spurious changes.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import os
+
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Mapping
+
+CSV_DELIMITER = "\t"
+LINE_TERMINATOR = "\r\n"
+
+Row = Mapping[str, object]
+
+
+def cell(value: object) -> str:
+    # actual booleans are written TRUE/FALSE, not 1/0 or True/False
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return "" if value is None else str(value)
+
+
+def encode_line(record: list[str]) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf, delimiter=CSV_DELIMITER, lineterminator=LINE_TERMINATOR).writerow(
+        record
+    )
+    return buf.getvalue().encode("utf-8")
+
+
+def iter_records(data: bytes) -> Iterator[tuple[list[str], int]]:
+    """Yield each record of `data` (the header first) with its end offset."""
+    pos = 0
+
+    def lines() -> Iterator[str]:
+        nonlocal pos
+        for line in data.splitlines(keepends=True):
+            pos += len(line)
+            yield line.decode("utf-8")
+
+    for record in csv.reader(lines(), delimiter=CSV_DELIMITER):
+        if record:
+            yield record, pos
+
+
+class TsvFile:
+    path: Path
+    fieldnames: list[str]
+    _data: bytes | None  # None once written, until the file is read again
+    _offsets: list[int]  # byte offset of each row, then of the end of the data
+    _index: dict[str, int]  # qid -> row number
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._load()
+
+    def _load(self) -> None:
+        data = self.path.read_bytes() if self.path.exists() else b""
+        records = iter_records(data)
+        self.fieldnames, end = next(records, ([], 0))
+        qid = self.fieldnames.index("qid") if "qid" in self.fieldnames else None
+        self._offsets = [end]
+        self._index = {}
+        for record, end in records:
+            if qid is not None and qid < len(record):
+                self._index[record[qid]] = len(self._offsets) - 1
+            self._offsets.append(end)
+        self._data = data
+
+    def _loaded(self) -> bytes:
+        if self._data is None:
+            self._load()
+        assert self._data is not None
+        return self._data
+
+    def __len__(self) -> int:
+        self._loaded()
+        return len(self._offsets) - 1
+
+    @property
+    def index(self) -> dict[str, int]:
+        self._loaded()
+        return self._index
+
+    def _line(self, i: int) -> bytes:
+        return self._loaded()[self._offsets[i] : self._offsets[i + 1]]
+
+    def _dict(self, record: list[str]) -> dict[str, str]:
+        record += [""] * (len(self.fieldnames) - len(record))
+        return dict(zip(self.fieldnames, record))
+
+    def row(self, i: int) -> dict[str, str]:
+        record = next(iter_records(self._line(i)), ([], 0))[0]
+        return self._dict(record)
+
+    def rows(self) -> Iterator[dict[str, str]]:
+        records = iter_records(self._loaded())
+        next(records, None)  # header
+        for record, _ in records:
+            yield self._dict(record)
+
+    def _encode(self, row: Row, fieldnames: list[str]) -> bytes:
+        extra = row.keys() - set(fieldnames)
+        if extra:
+            raise ValueError(f"row has fields not in fieldnames: {sorted(extra)}")
+        return encode_line([cell(row.get(name)) for name in fieldnames])
+
+    def save(
+        self,
+        rows: Iterable[Row],
+        fieldnames: list[str] | None = None,
+        expected_rows: int | None = None,
+    ) -> bool:
+        """Replace the content with `rows`; return whether the file changed.
+
+        Rows are consumed one at a time: leading rows equal to the current
+        ones are skipped, and the temporary file is opened at the first
+        difference, so the new content is never held in memory as a whole.
+        With `expected_rows`, the file is left untouched unless that many
+        rows were written.
+        """
+        self._loaded()
+        fieldnames = self.fieldnames if fieldnames is None else fieldnames
+        same_header = fieldnames == self.fieldnames and bool(self._data)
+        tmp = self._tmp_path()
+        out = None
+        count = 0
+        try:
+            for row in rows:
+                line = self._encode(row, fieldnames)
+                if out is None:
+                    if same_header and count < len(self) and line == self._line(count):
+                        count += 1
+                        continue
+                    out = self._open(tmp, fieldnames, count, same_header)
+                out.write(line)
+                count += 1
+            if expected_rows is not None and count != expected_rows:
+                raise ValueError(f"got {count} rows instead of {expected_rows}")
+            if out is None:
+                if same_header and count == len(self):
+                    return False
+                out = self._open(tmp, fieldnames, count, same_header)
+            self._close(out)
+        except BaseException:
+            if out is not None:
+                out.close()
+            tmp.unlink(missing_ok=True)
+            raise
+        self._replace(tmp, fieldnames)
+        return True
+
+    def patch(self, changes: Mapping[str, Mapping[str, object]]) -> bool:
+        """Set fields of the rows with the given qids; return whether the file changed."""
+        patched = {}
+        for qid, values in changes.items():
+            i = self.index[qid]
+            line = self._encode({**self.row(i), **values}, self.fieldnames)
+            if line != self._line(i):
+                patched[i] = line
+        if not patched:
+            return False
+        first = min(patched)
+        tmp = self._tmp_path()
+        out = self._open(tmp, self.fieldnames, first, True)
+        for i in range(first, len(self)):
+            out.write(patched.get(i) or self._line(i))
+        self._close(out)
+        self._replace(tmp, self.fieldnames)
+        return True
+
+    def _tmp_path(self) -> Path:
+        return self.path.with_name(f".{self.path.name}.tmp")
+
+    def _open(
+        self, tmp: Path, fieldnames: list[str], first: int, keep_prefix: bool
+    ) -> BinaryIO:
+        """Open `tmp` for writing rows from `first` on.
+
+        With `keep_prefix` the bytes of the current header and rows before
+        `first` are copied as is; otherwise a new header is written.
+        """
+        out = open(tmp, "wb")
+        if keep_prefix:
+            out.write(self._loaded()[: self._offsets[first]])
+        else:
+            out.write(encode_line(fieldnames))
+        return out
+
+    @staticmethod
+    def _close(out: BinaryIO) -> None:
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+
+    def _replace(self, tmp: Path, fieldnames: list[str]) -> None:
+        os.replace(tmp, self.path)
+        # read again on the next use only
+        self.fieldnames = fieldnames
+        self._data = None
@@ -0,0 +1,13 @@
+import argparse
+import os
+
+
+def add_jobs_argument(parser: argparse.ArgumentParser, work: str) -> None:
+    """Add the --jobs/-j option of the commands that can use worker processes."""
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help=f"Worker processes {work} (machine has {os.cpu_count()})",
+    )